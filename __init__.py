@@ -14,5 +14,6 @@ import bom
 import account
 import sale
 import currency
+import pricelist
 
 import wizard
@@ -9,8 +9,10 @@
 """
 from openerp.osv import osv, fields
 
+from .cache import RunCacheInvalidationMixin
 
-class Tax(osv.Model):
+
+class Tax(RunCacheInvalidationMixin, osv.Model):
     "Account Tax"
     _inherit = 'account.tax'
 
@@ -7,9 +7,38 @@
     :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import xmlrpclib
+
 from magento.api import API
 
 
+def multicall(api, calls, batch_size):
+    """
+    Sends the `calls` to magento in chunks of `batch_size` calls, each chunk
+    in a single multiCall request.
+
+    Magento does not stop a multiCall at the first fault. The fault is
+    returned in place of the result of the failed call, so one bad call does
+    not abort the rest of the chunk.
+
+    :param api: Logged in instance of magento API
+    :param calls: List of calls where each call is in the format
+                  [<resource path>, <list of arguments>]
+    :param batch_size: Maximum number of calls sent in one request
+    :return: List of results in the same order as `calls`. The result of a
+             call that failed is an `xmlrpclib.Fault`
+    """
+    results = []
+    for start in xrange(0, len(calls), batch_size):
+        for result in api.multiCall(calls[start:start + batch_size]):
+            if isinstance(result, dict) and result.get('isFault'):
+                result = xmlrpclib.Fault(
+                    result['faultCode'], result['faultMessage']
+                )
+            results.append(result)
+    return results
+
+
 class Core(API):
     """
     This API extends the API for the custom API implementation
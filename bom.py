@@ -68,19 +68,27 @@ class BoM(osv.Model):
         if not identified_boms:
             return
 
+        products = product_obj.find_or_create_all_using_magento_ids(
+            cursor, user, [item['product_id'] for item in order_data['items']],
+            context
+        )
+
+        def get_product(magento_id):
+            product = products.get(int(magento_id))
+            if not product:
+                product = product_obj.find_or_create_using_magento_id(
+                    cursor, user, magento_id, context=context
+                )
+            return product
+
         for item_id, data in identified_boms.iteritems():
-            bundle_product = product_obj.find_or_create_using_magento_id(
-                cursor, user, data['bundle']['product_id'], context=context
-            )
+            bundle_product = get_product(data['bundle']['product_id'])
             # It contains a list of tuples, in which the first element is the
             # product browse record and second is its quantity in the BoM
             child_products = [(
-                    product_obj.find_or_create_using_magento_id(
-                        cursor, user, each['product_id'], context=context
-                    ), (
-                        float(each['qty_ordered']) /
-                        float(data['bundle']['qty_ordered'])
-                    )
+                get_product(each['product_id']),
+                float(each['qty_ordered']) /
+                float(data['bundle']['qty_ordered'])
             ) for each in data['components']]
 
             # Here we match the sets of BoM components for equality
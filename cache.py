@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+    cache
+
+    Lookup cache for an import run
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: AGPLv3, see LICENSE for more details.
+"""
+import weakref
+
+from openerp import pooler
+
+
+class RunCache(object):
+    """
+    Caches the records looked up repeatedly while importing from magento,
+    like taxes, units of measure and order states, for as long as the import
+    run lasts.
+
+    The values are kept by model. A write on a model drops the values of
+    that model from the caches of all the runs in progress in the process.
+
+    The cache also keeps counters of what happened in the run, which are
+    reported as its statistics.
+    """
+
+    #: Caches of the runs in progress
+    _caches = weakref.WeakSet()
+
+    def __init__(self):
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+        self.counters = {}
+        self._caches.add(self)
+
+    def get(self, model, key, compute):
+        """
+        Returns the value cached for `key` of `model`. On a miss the value
+        is computed by calling `compute` and cached.
+
+        :param model: Name of the model the value comes from
+        :param key: Hashable key of the value in the model
+        :param compute: Callable which returns the value
+        """
+        values = self.values.setdefault(model, {})
+        if key in values:
+            self.hits += 1
+            return values[key]
+
+        self.misses += 1
+        values[key] = compute()
+        return values[key]
+
+    def get_many(self, model, keys):
+        """
+        Returns a dictionary of the values cached for those of `keys` of
+        `model` which are in the cache
+
+        :param model: Name of the model the values come from
+        :param keys: List of hashable keys of values in the model
+        """
+        values = self.values.get(model, {})
+        found = dict((key, values[key]) for key in keys if key in values)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def update(self, model, values):
+        """
+        Caches the `values` of `model`
+
+        :param model: Name of the model the values come from
+        :param values: Dictionary of values by their key
+        """
+        self.values.setdefault(model, {}).update(values)
+
+    def clear(self):
+        """
+        Drops all the values in the cache
+        """
+        self.values = {}
+
+    @classmethod
+    def invalidate(cls, model):
+        """
+        Drops the values of `model` from all the caches
+
+        :param model: Name of the model
+        """
+        for cache in list(cls._caches):
+            cache.values.pop(model, None)
+
+    def __deepcopy__(self, memo):
+        # The context is deepcopied in many places, but everything in the run
+        # must share the same cache
+        return self
+
+
+class RunCacheInvalidationMixin(object):
+    """
+    Drops the values of the model from the caches of all the runs in
+    progress when its records change
+
+    Models whose runs cache only the records found, which new records
+    cannot make stale, set `_run_cache_invalidate_on_create` to False so
+    that the records created by an import keep the cache.
+    """
+
+    _run_cache_invalidate_on_create = True
+
+    def create(self, cursor, user, values, context=None):
+        if self._run_cache_invalidate_on_create:
+            RunCache.invalidate(self._name)
+        return super(RunCacheInvalidationMixin, self).create(
+            cursor, user, values, context
+        )
+
+    def write(self, cursor, user, ids, values, context=None):
+        RunCache.invalidate(self._name)
+        return super(RunCacheInvalidationMixin, self).write(
+            cursor, user, ids, values, context
+        )
+
+    def unlink(self, cursor, user, ids, context=None):
+        RunCache.invalidate(self._name)
+        return super(RunCacheInvalidationMixin, self).unlink(
+            cursor, user, ids, context
+        )
+
+
+def read_committed(cursor, load):
+    """
+    Calls `load` with a new cursor on the database of `cursor` and returns
+    its result. The new cursor sees only what is committed, not what the
+    transaction of `cursor` has written but not committed yet.
+
+    This is how the indexes kept in the ORM cache are loaded. They are
+    shared by every transaction in the process, so they must not hold
+    records which may be rolled back.
+
+    :param cursor: Database cursor
+    :param load: Callable which takes a cursor
+    """
+    committed_cursor = pooler.get_db(cursor.dbname).cursor()
+    try:
+        return load(committed_cursor)
+    finally:
+        committed_cursor.close()
+
+
+def mark_written(cursor, model):
+    """
+    Records that the transaction of `cursor` has changed records of `model`
+
+    :param cursor: Database cursor
+    :param model: Name of the model
+    """
+    written = getattr(cursor, 'magento_written_models', None)
+    if written is None:
+        written = cursor.magento_written_models = set()
+    written.add(model)
+
+
+def has_written(cursor, model):
+    """
+    Tells if the transaction of `cursor` has changed records of `model`.
+    Such a transaction must not use the indexes of `model` in the ORM
+    cache, as it would load them again from records which differ from
+    what it sees.
+
+    :param cursor: Database cursor
+    :param model: Name of the model
+    """
+    return model in getattr(cursor, 'magento_written_models', ())
+
+
+def commit(cursor):
+    """
+    Commits the transaction of `cursor`. The changes it made are then seen
+    by the indexes loaded afterwards, so its marks of changed models are
+    dropped.
+
+    :param cursor: Database cursor
+    """
+    cursor.commit()
+    cursor.magento_written_models = set()
+
+
+def cached(context, model, key, compute):
+    """
+    Returns the value for `key` of `model` from the cache of the run in
+    context. If there is no cache in context, the value is just computed.
+
+    :param context: Application context
+    :param model: Name of the model the value comes from
+    :param key: Hashable key of the value in the model
+    :param compute: Callable which returns the value
+    """
+    cache = context and context.get('magento_cache')
+    if cache is None:
+        return compute()
+    return cache.get(model, key, compute)
+
+
+def count(context, name, value=1):
+    """
+    Adds `value` to the counter `name` of the run in context. Nothing is
+    counted if there is no run cache in context.
+
+    :param context: Application context
+    :param name: Name of the counter
+    :param value: Value to add to the counter
+    """
+    cache = context and context.get('magento_cache')
+    if cache is not None:
+        cache.counters[name] = cache.counters.get(name, 0) + value
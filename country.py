@@ -8,9 +8,37 @@
     :license: AGPLv3, see LICENSE for more details.
 """
 from openerp.osv import osv
+from openerp.tools import ormcache
 from openerp.tools.translate import _
 import pycountry
 
+from .cache import (
+    RunCacheInvalidationMixin, cached, count, has_written, mark_written,
+    read_committed
+)
+
+#: Upper cased names of the subdivisions of countries in pycountry by
+#: country code, filled for each country on first use
+_subdivision_names = {}
+
+
+def get_subdivision_names(country_code):
+    """
+    Returns the upper cased names of the subdivisions of a country in
+    pycountry
+
+    :param country_code: ISO code of the country
+    :return: Set of names
+    """
+    if country_code not in _subdivision_names:
+        _subdivision_names[country_code] = frozenset(
+            subdivision.name.upper()
+            for subdivision in pycountry.subdivisions.get(
+                country_code=country_code
+            )
+        )
+    return _subdivision_names[country_code]
+
 
 class Country(osv.osv):
     "Country"
@@ -26,6 +54,18 @@ class Country(osv.osv):
         :param context: Application context
         :return: Browse record of country if found else raises error
         """
+        country_id = not has_written(cursor, self._name) and \
+            self.get_code_index(cursor, user).get(code)
+        if country_id:
+            country = self.browse(cursor, user, country_id, context=context)
+            # Another worker may reload the index before a change is
+            # committed, so a hit is used only if it still has the code
+            if country.code == code:
+                count(context, 'index_hits')
+                return country
+
+        # The index holds only the countries committed when it was loaded,
+        # so newer ones are found by a search
         country_ids = self.search(
             cursor, user, [('code', '=', code)], context=context
         )
@@ -41,8 +81,45 @@ class Country(osv.osv):
         )
         return country
 
+    @ormcache(skiparg=2)
+    def get_code_index(self, cursor, user):
+        """
+        Returns the index of countries by their code. The index is kept in
+        the ORM cache, which is cleared on all the workers when countries
+        change.
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :return: Dictionary of country IDs by code
+        """
+        def load(committed_cursor):
+            return dict(
+                (country['code'], country['id'])
+                for country in self.read(
+                    committed_cursor, user,
+                    self.search(committed_cursor, user, []), ['code']
+                )
+            )
+
+        return read_committed(cursor, load)
+
+    def create(self, cursor, user, values, context=None):
+        mark_written(cursor, self._name)
+        self.clear_caches()
+        return super(Country, self).create(cursor, user, values, context)
+
+    def write(self, cursor, user, ids, values, context=None):
+        mark_written(cursor, self._name)
+        self.clear_caches()
+        return super(Country, self).write(cursor, user, ids, values, context)
+
+    def unlink(self, cursor, user, ids, context=None):
+        mark_written(cursor, self._name)
+        self.clear_caches()
+        return super(Country, self).unlink(cursor, user, ids, context)
 
-class CountryState(osv.Model):
+
+class CountryState(RunCacheInvalidationMixin, osv.Model):
     "Country State"
     _inherit = 'res.country.state'
 
@@ -85,17 +162,63 @@ class CountryState(osv.Model):
         :param context: Application context
         :return: Browse record of record found
         """
-        state_ids = self.search(
-            cursor, user, [
-                ('name', 'ilike', region),
-                ('country_id', '=', country.id),
-            ], context=context
+        # Most regions are found by their exact name in the index of states
+        index = not has_written(cursor, self._name) and \
+            self.get_region_index(cursor, user) or {}
+        state_id = index.get((country.code, region.upper()))
+        if state_id:
+            state = self.browse(cursor, user, state_id, context=context)
+            # Another worker may reload the index before a change is
+            # committed, so a hit is used only if it still has the region
+            if state.country_id.id == country.id and \
+                    state.name.upper() == region.upper():
+                count(context, 'index_hits')
+                return state
+
+        # The index holds only the states committed when it was loaded, so
+        # newer states, like those created by this transaction, are found
+        # by a search
+        state_ids = cached(
+            context, self._name, (country.id, region),
+            lambda: self.search(
+                cursor, user, [
+                    ('name', 'ilike', region),
+                    ('country_id', '=', country.id),
+                ], context=context
+            )
         )
 
         return state_ids and self.browse(
             cursor, user, state_ids[0], context=context
         ) or None
 
+    @ormcache(skiparg=2)
+    def get_region_index(self, cursor, user):
+        """
+        Returns the index of states by the code of their country and their
+        upper cased name. The index is kept in the ORM cache, which is
+        cleared on all the workers when states change.
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :return: Dictionary of state IDs by (country code, name)
+        """
+        def load(committed_cursor):
+            committed_cursor.execute(
+                'SELECT country.code, upper(state.name), state.id '
+                'FROM res_country_state AS state '
+                'JOIN res_country AS country '
+                'ON country.id = state.country_id '
+                'ORDER BY state.id DESC'
+            )
+            # Ordered so that the first of states with the same name wins
+            return dict(
+                ((code, name), state_id)
+                for code, name, state_id in committed_cursor.fetchall()
+            )
+
+        return read_committed(cursor, load)
+
     def create_using_magento_region(
         self, cursor, user, country, region, context
     ):
@@ -111,11 +234,8 @@ class CountryState(osv.Model):
         """
         code = None
         try:
-            for subdivision in pycountry.subdivisions.get(
-                    country_code=country.code):
-                if subdivision.name.upper() == region.upper():
-                    code = ''.join(list(region)[:3]).upper()
-                    break
+            if region.upper() in get_subdivision_names(country.code):
+                code = ''.join(list(region)[:3]).upper()
             if not code:
                 if country.code == 'US':
                     code = 'APO'
@@ -136,3 +256,20 @@ class CountryState(osv.Model):
             )
 
         return self.browse(cursor, user, state_id, context=context)
+
+    def create(self, cursor, user, values, context=None):
+        mark_written(cursor, self._name)
+        self.clear_caches()
+        return super(CountryState, self).create(cursor, user, values, context)
+
+    def write(self, cursor, user, ids, values, context=None):
+        mark_written(cursor, self._name)
+        self.clear_caches()
+        return super(CountryState, self).write(
+            cursor, user, ids, values, context
+        )
+
+    def unlink(self, cursor, user, ids, context=None):
+        mark_written(cursor, self._name)
+        self.clear_caches()
+        return super(CountryState, self).unlink(cursor, user, ids, context)
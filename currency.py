@@ -8,8 +8,11 @@
     :license: AGPLv3, see LICENSE for more details.
 """
 from openerp.osv import osv
+from openerp.tools import ormcache
 from openerp.tools.translate import _
 
+from .cache import count, has_written, mark_written, read_committed
+
 
 class Currency(osv.osv):
     "Currency"
@@ -25,10 +28,20 @@ class Currency(osv.osv):
         :param context: Application context
         :return: Browse record of currency if found else raises error
         """
+        currency_id = not has_written(cursor, self._name) and \
+            self.get_code_index(cursor, user).get(code)
+        if currency_id:
+            currency = self.browse(cursor, user, currency_id, context=context)
+            # Another worker may reload the index before a change is
+            # committed, so a hit is used only if it still has the code
+            if currency.name == code:
+                count(context, 'index_hits')
+                return currency
+
+        # The index holds only the currencies committed when it was loaded,
+        # so newer ones are found by a search
         currency_ids = self.search(
-            cursor, user, [
-                ('name', '=', code)
-            ], context=context
+            cursor, user, [('name', '=', code)], context=context
         )
 
         if not currency_ids:
@@ -41,3 +54,42 @@ class Currency(osv.osv):
             cursor, user, currency_ids[0], context=context
         )
         return currency
+
+    @ormcache(skiparg=2)
+    def get_code_index(self, cursor, user):
+        """
+        Returns the index of currencies by their code. The index is kept in
+        the ORM cache, which is cleared on all the workers when currencies
+        change.
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :return: Dictionary of currency IDs by code
+        """
+        def load(committed_cursor):
+            # Read in reverse so that the first of currencies with the same
+            # code wins, as it would in a search
+            return dict(
+                (currency['name'], currency['id'])
+                for currency in reversed(self.read(
+                    committed_cursor, user,
+                    self.search(committed_cursor, user, []), ['name']
+                ))
+            )
+
+        return read_committed(cursor, load)
+
+    def create(self, cursor, user, values, context=None):
+        mark_written(cursor, self._name)
+        self.clear_caches()
+        return super(Currency, self).create(cursor, user, values, context)
+
+    def write(self, cursor, user, ids, values, context=None):
+        mark_written(cursor, self._name)
+        self.clear_caches()
+        return super(Currency, self).write(cursor, user, ids, values, context)
+
+    def unlink(self, cursor, user, ids, context=None):
+        mark_written(cursor, self._name)
+        self.clear_caches()
+        return super(Currency, self).unlink(cursor, user, ids, context)
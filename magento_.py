@@ -5,22 +5,34 @@
     :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) LTD
     :license: AGPLv3, see LICENSE for more details
 '''
+import hashlib
+import json
 import logging
 import xmlrpclib
 from copy import deepcopy
+from datetime import datetime, timedelta
 import time
 
 from openerp.osv import fields, osv
-from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
+from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT, float_compare
 from openerp.tools.translate import _
 import openerp.addons.decimal_precision as dp
 import magento
 
-from .api import OrderConfig
+from .api import OrderConfig, multicall
+from .cache import RunCache, RunCacheInvalidationMixin, cached, commit
+from .product import INFO_BATCH_SIZE
+from .session import job_session
 
 
 _logger = logging.getLogger(__name__)
 
+#: Maximum number of tier price updates sent in one multiCall request
+TIER_PRICE_BATCH_SIZE = 50
+
+#: Maximum number of shipment calls sent in one multiCall request
+SHIPMENT_BATCH_SIZE = 50
+
 
 class Instance(osv.Model):
     """Magento Instance
@@ -55,6 +67,18 @@ class Instance(osv.Model):
             'magento.instance.carrier', 'instance',
             'Carriers / Shipping Methods'
         ),
+        order_fetch_workers=fields.integer(
+            'Order Fetch Workers', required=True,
+            help="Maximum number of orders whose details are fetched from "
+            "magento at the same time while importing orders",
+        ),
+        order_import_window=fields.integer(
+            'Order Import Window (Hours)',
+            help="Orders are listed and imported in windows of this many "
+            "hours of their update time, and the last order import time of "
+            "the store view is moved ahead after each window. Leave empty "
+            "to list all the orders to be imported at once",
+        ),
     )
 
     def default_company(self, cursor, user, context):
@@ -73,7 +97,8 @@ class Instance(osv.Model):
     _defaults = dict(
         active=lambda *a: 1,
         company=default_company,
-        order_prefix=lambda *a: 'mag_'
+        order_prefix=lambda *a: 'mag_',
+        order_fetch_workers=lambda *a: 1,
     )
 
     _sql_constraints = [
@@ -106,7 +131,7 @@ class Instance(osv.Model):
                 )
 
 
-class InstanceWebsite(osv.Model):
+class InstanceWebsite(RunCacheInvalidationMixin, osv.Model):
     """Magento Instance Website
 
     A magento instance can have multiple websites.
@@ -142,11 +167,44 @@ class InstanceWebsite(osv.Model):
         ),
         magento_root_category_id=fields.integer(
             'Magento Root Category ID', required=True,
-        )
+        ),
+        stock_location=fields.many2one(
+            'stock.location', 'Stock Location',
+            help="Stock exported to magento for this website is computed "
+            "from this location. If empty, the stock in all the warehouses "
+            "is used",
+        ),
+        inventory_batch_size=fields.integer(
+            'Inventory Export Batch Size', required=True,
+            help="Number of product stock updates sent to magento in a "
+            "single request while exporting inventory. A value of 1 sends "
+            "one request per product",
+        ),
+        last_catalog_update_time=fields.datetime(
+            'Last Catalog Update Time', readonly=True,
+            help="Only the products changed on magento since this time are "
+            "updated by the next catalog update",
+        ),
+        catalog_update_started=fields.datetime(
+            'Catalog Update Started', readonly=True,
+            help="Start of the catalog update in progress or interrupted",
+        ),
+        catalog_update_resume_id=fields.integer(
+            'Catalog Update Resume ID', readonly=True,
+            help="Magento ID of the last product updated by the catalog "
+            "update in progress or interrupted",
+        ),
+        merge_guest_customers=fields.boolean(
+            'Merge Guest Customers',
+            help="If checked, the orders placed by guests with the same "
+            "email are imported under a single partner, instead of a new "
+            "partner for each order",
+        ),
     )
 
     _defaults = dict(
         magento_root_category_id=lambda *a: 1,
+        inventory_batch_size=lambda *a: 1,
     )
 
     _sql_constraints = [(
@@ -163,10 +221,25 @@ class InstanceWebsite(osv.Model):
         :param context: Application context
         :return: UOM browse record
         """
-        website = self.browse(
-            cursor, user, context['magento_website'], context=context
+        return cached(
+            context, self._name, context['magento_website'],
+            lambda: self.get_default_uom_of_website(
+                cursor, user, context['magento_website'], context
+            )
         )
 
+    def get_default_uom_of_website(self, cursor, user, website_id, context):
+        """
+        Get default product uom of the website with `website_id`
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param website_id: ID of website
+        :param context: Application context
+        :return: UOM browse record
+        """
+        website = self.browse(cursor, user, website_id, context=context)
+
         if not website.default_product_uom:
             raise osv.except_osv(
                 _('UOM not found!'),
@@ -256,6 +329,193 @@ class InstanceWebsite(osv.Model):
                 cursor, user, website, context
             )
 
+    def update_catalog(self, cursor, user, ids=None, context=None):
+        """
+        Updates the products changed on magento since the last update
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param ids: List of ids of website
+        :param context: Application context
+        """
+        if not ids:
+            ids = self.search(cursor, user, [], context)
+
+        # Commit each batch of products updated, so that the next run
+        # resumes from the last batch committed if this one fails
+        if context:
+            context['magento_commit_per_page'] = True
+        else:
+            context = {'magento_commit_per_page': True}
+
+        for website in self.browse(cursor, user, ids, context):
+            if not website.instance.active:
+                continue
+            self.update_catalog_from_magento(cursor, user, website, context)
+
+    def update_catalog_from_magento(self, cursor, user, website, context):
+        """
+        Updates the products of the website changed on magento since the
+        last catalog update
+
+        The products are listed with a filter on their update time and
+        only the ones already imported are fetched, in multiCall requests.
+        They are updated in batches sorted by their magento ID and the
+        progress is recorded on the website after each batch. An
+        interrupted update is resumed after the last batch recorded.
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param website: Browse record of website
+        :param context: Application context
+        :return: List of products updated
+        """
+        product_obj = self.pool.get('product.product')
+        magento_product_obj = self.pool.get('magento.website.product')
+
+        new_context = dict(context or {})
+        new_context.update({
+            'magento_instance': website.instance.id,
+            'magento_website': website.id,
+        })
+        if not new_context.get('magento_cache'):
+            new_context['magento_cache'] = RunCache()
+        counters = new_context['magento_cache'].counters
+
+        if context and context.get('force_full_catalog_update'):
+            last_update_time = None
+            started, resume_id = None, 0
+        else:
+            last_update_time = website.last_catalog_update_time
+            started = website.catalog_update_started
+            resume_id = website.catalog_update_resume_id
+        if not started:
+            started = datetime.utcnow().strftime(
+                DEFAULT_SERVER_DATETIME_FORMAT
+            )
+            self.write(cursor, user, [website.id], {
+                'catalog_update_started': started,
+                'catalog_update_resume_id': 0,
+            }, context=context)
+            resume_id = 0
+
+        products = []
+        with job_session(website.instance, new_context) as session:
+            product_api = session.get(magento.Product)
+
+            filters = None
+            if last_update_time:
+                filters = {'updated_at': {'gteq': last_update_time}}
+            magento_ids = sorted(
+                int(mag_product['product_id'])
+                for mag_product in product_api.list(
+                    filters, website.stores[0].store_views[0].magento_id
+                )
+            )
+            magento_ids = [
+                magento_id for magento_id in magento_ids
+                if magento_id > resume_id
+            ]
+
+            # Only the products already imported are updated
+            record_ids = magento_product_obj.search(cursor, user, [
+                ('magento_id', 'in', magento_ids),
+                ('website', '=', website.id),
+            ], context=context)
+            product_ids = dict(
+                (record['magento_id'], record['product'][0])
+                for record in magento_product_obj.read(
+                    cursor, user, record_ids, ['magento_id', 'product'],
+                    context=context
+                )
+            )
+
+            for start in xrange(0, len(magento_ids), INFO_BATCH_SIZE):
+                batch = [
+                    magento_id for magento_id in
+                    magento_ids[start:start + INFO_BATCH_SIZE]
+                    if magento_id in product_ids
+                ]
+                results = multicall(product_api, [
+                    ['catalog_product.info', [magento_id]]
+                    for magento_id in batch
+                ], INFO_BATCH_SIZE)
+
+                for magento_id, product_data in zip(batch, results):
+                    if isinstance(product_data, xmlrpclib.Fault):
+                        _logger.error(
+                            'Product %s could not be updated from magento: '
+                            '%s' % (magento_id, product_data.faultString)
+                        )
+                        continue
+                    products.append(
+                        product_obj.update_from_magento_using_data(
+                            cursor, user, product_obj.browse(
+                                cursor, user, product_ids[magento_id],
+                                context=new_context
+                            ), product_data, new_context
+                        )
+                    )
+
+                self.write(cursor, user, [website.id], {
+                    'catalog_update_resume_id':
+                        magento_ids[start:start + INFO_BATCH_SIZE][-1],
+                }, context=context)
+                if context and context.get('magento_commit_per_page'):
+                    cursor.commit()
+
+        # The products changed while this update was running are updated
+        # again by the next one
+        self.write(cursor, user, [website.id], {
+            'last_catalog_update_time': started,
+            'catalog_update_started': False,
+            'catalog_update_resume_id': 0,
+        }, context=context)
+
+        _logger.info(
+            'Catalog of website %s updated from magento: %d products '
+            'written, %d products unchanged' % (
+                website.name, counters.get('products_written', 0),
+                counters.get('products_skipped', 0),
+            )
+        )
+
+        return products
+
+    def get_product_quantities(self, cursor, user, website, context):
+        """
+        Computes the quantity available of all the products of this website
+        together, instead of computing the function field once per product.
+        If a stock location is set on the website, only the stock in that
+        location (and its children) is considered.
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param website: Browse record of website
+        :param context: Application context
+        :return: Dictionary of quantity available by product ID
+        """
+        product_obj = self.pool.get('product.product')
+
+        product_ids = list(set([
+            magento_product.product.id
+            for magento_product in website.magento_products
+        ]))
+        if not product_ids:
+            return {}
+
+        stock_context = dict(context or {})
+        if website.stock_location:
+            stock_context['location'] = website.stock_location.id
+
+        return dict([
+            (product['id'], product['qty_available'])
+            for product in product_obj.read(
+                cursor, user, product_ids, ['qty_available'],
+                context=stock_context
+            )
+        ])
+
     def export_inventory_to_magento(
         self, cursor, user, website, context
     ):
@@ -269,26 +529,80 @@ class InstanceWebsite(osv.Model):
         :param context: Application context
         :return: List of products
         """
+        magento_product_obj = self.pool.get('magento.website.product')
+
         products = []
         instance = website.instance
-        for magento_product in website.magento_products:
-            products.append(magento_product.product)
+        force_full = context and context.get('force_full_inventory_export')
 
-            is_in_stock = '1' if magento_product.product.qty_available > 0 \
-                else '0'
+        quantities = self.get_product_quantities(
+            cursor, user, website, context
+        )
+        precision = self.pool.get('decimal.precision').precision_get(
+            cursor, user, 'Product Unit of Measure'
+        )
 
-            product_data = {
-                'qty': magento_product.product.qty_available,
+        stock_data = []
+        for magento_product in website.magento_products:
+            qty = quantities[magento_product.product.id]
+            is_in_stock = '1' if qty > 0 else '0'
+
+            if not force_full and \
+                    magento_product.exported_is_in_stock == is_in_stock and \
+                    not float_compare(
+                        magento_product.exported_qty, qty,
+                        precision_digits=precision
+                    ):
+                # Stock has not changed since the last export
+                continue
+
+            stock_data.append((magento_product, {
+                'qty': qty,
                 'is_in_stock': is_in_stock,
-            }
+            }))
 
-            # Update stock information to magento
-            with magento.Inventory(
-                instance.url, instance.api_user, instance.api_key
-            ) as inventory_api:
-                inventory_api.update(
-                    magento_product.magento_id, product_data
+        with job_session(instance, context) as session:
+            inventory_api = session.get(magento.Inventory)
+
+            if website.inventory_batch_size > 1:
+                results = multicall(inventory_api, [
+                    ['cataloginventory_stock_item.update', [
+                        magento_product.magento_id, product_data
+                    ]] for magento_product, product_data in stock_data
+                ], website.inventory_batch_size)
+            else:
+                # Update stock information to magento
+                results = [
+                    inventory_api.update(
+                        magento_product.magento_id, product_data
+                    ) for magento_product, product_data in stock_data
+                ]
+
+        # Records exported with same stock data are updated together
+        exported = {}
+        for (magento_product, product_data), result in zip(
+            stock_data, results
+        ):
+            if isinstance(result, xmlrpclib.Fault):
+                # Report the product which failed and continue with the rest
+                _logger.error(
+                    'Stock of product %s could not be exported to magento: '
+                    '%s' % (
+                        magento_product.product.default_code,
+                        result.faultString
+                    )
                 )
+                continue
+            products.append(magento_product.product)
+            exported.setdefault(
+                (product_data['qty'], product_data['is_in_stock']), []
+            ).append(magento_product.id)
+
+        for (qty, is_in_stock), record_ids in exported.iteritems():
+            magento_product_obj.write(cursor, user, record_ids, {
+                'exported_qty': qty,
+                'exported_is_in_stock': is_in_stock,
+            }, context=context)
 
         return products
 
@@ -366,61 +680,201 @@ class WebsiteStore(osv.Model):
             }, context=context
         )
 
+    def export_tier_prices(self, cursor, user, ids=None, context=None):
+        """
+        Exports the changed tier prices of products to magento on cron
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param ids: List of ids of store
+        :param context: Application context
+        """
+        if not ids:
+            ids = self.search(cursor, user, [], context)
+
+        if context:
+            context = dict(context)
+        else:
+            context = {}
+
+        for store in self.browse(cursor, user, ids, context):
+            if not store.shop or not store.website.instance.active:
+                continue
+            context['magento_store'] = store.id
+            self.export_tier_prices_to_magento(cursor, user, store, context)
+
     def export_tier_prices_to_magento(
         self, cursor, user, store, context
     ):
         """
         Exports tier prices of products from openerp to magento for this store
 
+        The prices of all the products are computed together and sent to
+        magento in multiCall requests over one session. Only the products
+        whose tier prices changed since they were last exported are sent,
+        unless `force_full_tier_price_export` is set in context.
+
         :param cursor: Database cursor
         :param user: ID of current user
         :param store: Browse record of store
         :param context: Application context
         :return: List of products
         """
-        pricelist_obj = self.pool.get('product.pricelist')
+        tier_price_export_obj = self.pool.get(
+            'magento.store.tier_price_export'
+        )
+
+        price_data = self.get_tier_price_data_of_products(
+            cursor, user, store, [
+                magento_product.product
+                for magento_product in store.website.magento_products
+            ], context
+        )
+
+        fingerprints = dict(
+            (product_id, tier_price_export_obj.get_fingerprint(data))
+            for product_id, data in price_data.iteritems()
+        )
+        if context and context.get('force_full_tier_price_export'):
+            magento_products = store.website.magento_products
+        else:
+            exported = tier_price_export_obj.get_fingerprints(
+                cursor, user, store.id, context
+            )
+            magento_products = [
+                magento_product
+                for magento_product in store.website.magento_products
+                if exported.get(magento_product.product.id) !=
+                fingerprints[magento_product.product.id]
+            ]
 
-        products = []
         instance = store.website.instance
-        for magento_product in store.website.magento_products:
-            products.append(magento_product.product)
+        with job_session(instance, context) as session:
+            results = multicall(session.get(magento.ProductTierPrice), [
+                ['catalog_product_attribute_tier_price.update', [
+                    magento_product.magento_id,
+                    price_data[magento_product.product.id]
+                ]] for magento_product in magento_products
+            ], TIER_PRICE_BATCH_SIZE)
 
-            price_tiers = magento_product.product.price_tiers or \
-                store.price_tiers
-
-            price_data = []
-            for tier in price_tiers:
-                if hasattr(tier, 'product'):
-                    # The price tier comes from a product, then it has a
-                    # function field for price, we use it directly
-                    price = tier.price
-                else:
-                    # The price tier comes from the default tiers on store,
-                    # we donr have a product on tier, so we use the current
-                    # product in loop for computing the price for this tier
-                    price = pricelist_obj.price_get(
-                        cursor, user, [store.shop.pricelist_id.id],
-                        magento_product.product.id,
-                        tier.quantity, context={
-                            'uom': store.website.default_product_uom.id
-                        }
-                    )[store.shop.pricelist_id.id]
-
-                price_data.append({
-                    'qty': tier.quantity,
-                    'price': price,
-                })
-
-            # Update stock information to magento
-            with magento.ProductTierPrice(
-                instance.url, instance.api_user, instance.api_key
-            ) as tier_price_api:
-                tier_price_api.update(
-                    magento_product.magento_id, price_data
+        products = []
+        for magento_product, result in zip(magento_products, results):
+            if isinstance(result, xmlrpclib.Fault):
+                # Report the product which failed and continue with the rest
+                _logger.error(
+                    'Tier prices of product %s could not be exported to '
+                    'magento: %s' % (
+                        magento_product.product.default_code,
+                        result.faultString
+                    )
                 )
+                continue
+            products.append(magento_product.product)
+
+        tier_price_export_obj.record(cursor, user, store.id, dict(
+            (product.id, fingerprints[product.id]) for product in products
+        ), context)
 
         return products
 
+    def get_tier_price_data_of_products(
+        self, cursor, user, store, products, context
+    ):
+        """
+        Returns the tier prices of the products to be exported to magento
+        for this store
+
+        The tiers of a product are its own tiers if it has any, else the
+        default tiers of the store.
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param store: Browse record of store
+        :param products: List of browse records of product
+        :param context: Application context
+        :return: Dictionary of the list of dictionaries of quantity and
+                 price by product ID
+        """
+        quantities = dict(
+            (product.id, [
+                tier.quantity
+                for tier in product.price_tiers or store.price_tiers
+            ]) for product in products
+        )
+
+        prices = self.get_tier_prices(cursor, user, store, [
+            (product_id, quantity)
+            for product_id, product_quantities in quantities.iteritems()
+            for quantity in product_quantities
+        ], context)
+
+        return dict(
+            (product_id, [{
+                'qty': quantity,
+                'price': prices[(product_id, quantity)],
+            } for quantity in product_quantities])
+            for product_id, product_quantities in quantities.iteritems()
+        )
+
+    def get_tier_prices(
+        self, cursor, user, store, product_quantities, context
+    ):
+        """
+        Computes the prices of products for quantities on the pricelist of
+        the store
+
+        The prices are computed with one pricelist evaluation for each
+        quantity, for all the products at once. They are cached for the run
+        by the pricelist version they were computed from.
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param store: Browse record of store
+        :param product_quantities: List of tuples of product ID and quantity
+        :param context: Application context
+        :return: Dictionary of prices by tuple of product ID and quantity
+        """
+        pricelist_obj = self.pool.get('product.pricelist')
+        version_obj = self.pool.get('product.pricelist.version')
+
+        pricelist = store.shop.pricelist_id
+        uom_id = store.website.default_product_uom.id
+
+        today = time.strftime('%Y-%m-%d')
+        version_ids = version_obj.search(cursor, user, [
+            ('pricelist_id', '=', pricelist.id),
+            '|', ('date_start', '=', False), ('date_start', '<=', today),
+            '|', ('date_end', '=', False), ('date_end', '>=', today),
+        ], limit=1, context=context)
+        version_id = version_ids and version_ids[0] or None
+
+        products_by_quantity = {}
+        for product_id, quantity in product_quantities:
+            products_by_quantity.setdefault(quantity, set()).add(product_id)
+
+        prices = {}
+        for quantity, product_ids in products_by_quantity.iteritems():
+            version_prices = cached(
+                context, version_obj._name, (version_id, uom_id, quantity),
+                dict
+            )
+            missing_ids = product_ids - set(version_prices)
+            if missing_ids:
+                results = pricelist_obj.price_get_multi(
+                    cursor, user, [pricelist.id], [
+                        (product_id, quantity, None)
+                        for product_id in missing_ids
+                    ], context={'uom': uom_id}
+                )
+                for product_id in missing_ids:
+                    version_prices[product_id] = \
+                        results[product_id][pricelist.id]
+
+            for product_id in product_ids:
+                prices[(product_id, quantity)] = version_prices[product_id]
+
+        return prices
+
 
 class WebsiteStoreView(osv.Model):
     """Magento Website Store View
@@ -516,6 +970,13 @@ class WebsiteStoreView(osv.Model):
         if not ids:
             ids = self.search(cursor, user, [], context)
 
+        # Commit each window of imported orders, so that the next run
+        # resumes from the last window committed if this one fails
+        if context:
+            context['magento_commit_per_page'] = True
+        else:
+            context = {'magento_commit_per_page': True}
+
         for store_view in self.browse(cursor, user, ids, context):
             self.import_orders_from_store_view(
                 cursor, user, store_view, context
@@ -546,8 +1007,10 @@ class WebsiteStoreView(osv.Model):
         :param context: dictionary of application context data
         :return: list of sale ids
         """
-        sale_obj = self.pool.get('sale.order')
+        failure_obj = self.pool.get('magento.import.failure')
         magento_state_obj = self.pool.get('magento.order_state')
+        sale_obj = self.pool.get('sale.order')
+        checkpoint_obj = self.pool.get('magento.store_view.order_checkpoint')
 
         instance = store_view.instance
         if context:
@@ -560,6 +1023,8 @@ class WebsiteStoreView(osv.Model):
             'magento_website': store_view.website.id,
             'magento_store_view': store_view.id,
         })
+        if not new_context.get('magento_cache'):
+            new_context['magento_cache'] = RunCache()
         new_sales = []
 
         order_states = magento_state_obj.search(cursor, user, [
@@ -581,9 +1046,7 @@ class WebsiteStoreView(osv.Model):
                 )
             )
 
-        with magento.Order(
-            instance.url, instance.api_user, instance.api_key
-        ) as order_api:
+        with job_session(instance, new_context) as session:
             # Filter orders with date and store_id using list()
             # then get info of each order using info()
             # and call find_or_create_using_magento_data on sale
@@ -591,30 +1054,219 @@ class WebsiteStoreView(osv.Model):
                 'store_id': {'=': store_view.magento_id},
                 'state': {'in': order_states_to_import_in},
             }
-            if store_view.last_order_import_time:
-                filter.update({
-                    'updated_at': {'gteq': store_view.last_order_import_time},
-                })
-            self.write(cursor, user, [store_view.id], {
-                'last_order_import_time': time.strftime(
-                    DEFAULT_SERVER_DATETIME_FORMAT
+
+            for window_end, orders in self.list_orders_to_import(
+                cursor, user, store_view, session, filter, context
+            ):
+                last_updated_at = None
+
+                # Orders already imported are not fetched again. Windows of
+                # update time overlap, so this saves most of the calls.
+                imported_ids = sale_obj.get_imported_magento_ids(
+                    cursor, user, [
+                        order['order_id'] for order in orders
+                        if order.get('order_id')
+                    ], new_context
                 )
-            }, context=context)
-            orders = order_api.list(filter)
-            for order in orders:
-                new_sales.append(
-                    sale_obj.find_or_create_using_magento_data(
-                        cursor, user,
-                        order_api.info(order['increment_id']), new_context
-                    )
+                orders_to_fetch = []
+                for order in orders:
+                    if order.get('order_id') and \
+                            int(order['order_id']) in imported_ids:
+                        last_updated_at = max(
+                            last_updated_at, order.get('updated_at')
+                        )
+                    else:
+                        orders_to_fetch.append(order)
+
+                # The details of orders are fetched concurrently, but the
+                # sales are created one at a time as the cursor is not
+                # thread safe
+                orders_data = list(session.imap(
+                    magento.Order, 'info',
+                    [order['increment_id'] for order in orders_to_fetch],
+                    instance.order_fetch_workers
+                ))
+                self.prefetch_products(
+                    cursor, user, orders_data, new_context
                 )
+                self.prefetch_customers(
+                    cursor, user, orders_data, new_context
+                )
+
+                for order_data in orders_data:
+                    # A failed order is queued to be retried and does not
+                    # stop the import of the rest
+                    sale = failure_obj.import_order(
+                        cursor, user, order_data, new_context
+                    )
+                    if sale:
+                        new_sales.append(sale)
+                    last_updated_at = max(
+                        last_updated_at, order_data['updated_at']
+                    )
+
+                # The checkpoint is written in the same transaction as the
+                # sales of this window. The next import starts from here.
+                if last_updated_at:
+                    checkpoint_obj.advance(
+                        cursor, user, store_view.id, last_updated_at, context
+                    )
+                self.write(cursor, user, [store_view.id], {
+                    'last_order_import_time': window_end,
+                }, context=context)
+                if context and context.get('magento_commit_per_page'):
+                    commit(cursor)
+
+        cache = new_context['magento_cache']
+        _logger.info(
+            'Orders of store view %s imported from magento: %d sales '
+            'created, %d lookups found in the run cache, %d in the indexes '
+            'of the ORM cache' % (
+                store_view.name, len(new_sales), cache.hits,
+                cache.counters.get('index_hits', 0),
+            )
+        )
 
         return new_sales
 
+    def prefetch_products(self, cursor, user, orders_data, context):
+        """
+        Find or create the products of all the items in `orders_data` at
+        once. They are then found in the cache of the import run when the
+        sales are created.
+
+        This only saves queries and API calls. If it fails, the products
+        are left to be resolved order by order, where a failure only holds
+        back the order which needs the product.
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param orders_data: List of order data from magento
+        :param context: Application context
+        """
+        product_obj = self.pool.get('product.product')
+
+        magento_ids = set()
+        for order_data in orders_data:
+            magento_ids.update(
+                item['product_id'] for item in order_data['items']
+            )
+        if not magento_ids:
+            return
+
+        cursor.execute('SAVEPOINT magento_product_prefetch')
+        try:
+            product_obj.find_or_create_all_using_magento_ids(
+                cursor, user, list(magento_ids), context
+            )
+        except Exception:
+            cursor.execute('ROLLBACK TO SAVEPOINT magento_product_prefetch')
+            # The records created in the savepoint are gone, and so must be
+            # anything cached about them, like the category index
+            if context.get('magento_cache'):
+                context['magento_cache'].clear()
+            _logger.exception('Products of orders could not be prefetched')
+        else:
+            cursor.execute('RELEASE SAVEPOINT magento_product_prefetch')
+
+    def prefetch_customers(self, cursor, user, orders_data, context):
+        """
+        Find or create the partners of all the customers who placed the
+        orders in `orders_data` at once. They are then found in the cache of
+        the import run when the sales are created. Guest customers have no
+        ID on magento and are left to the sales.
+
+        Like the prefetch of products, a failure here is not fatal.
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param orders_data: List of order data from magento
+        :param context: Application context
+        """
+        partner_obj = self.pool.get('res.partner')
+
+        magento_ids = set(
+            order_data['customer_id'] for order_data in orders_data
+            if order_data.get('customer_id')
+        )
+        if not magento_ids:
+            return
+
+        cursor.execute('SAVEPOINT magento_customer_prefetch')
+        try:
+            partner_obj.find_or_create_all_using_magento_ids(
+                cursor, user, list(magento_ids), context
+            )
+        except Exception:
+            cursor.execute('ROLLBACK TO SAVEPOINT magento_customer_prefetch')
+            # The partners created in the savepoint are gone
+            if context.get('magento_cache'):
+                context['magento_cache'].clear()
+            _logger.exception('Customers of orders could not be prefetched')
+        else:
+            cursor.execute('RELEASE SAVEPOINT magento_customer_prefetch')
+
+    def list_orders_to_import(
+        self, cursor, user, store_view, session, filter, context
+    ):
+        """
+        Lists the orders updated since the last order import, one window of
+        time at a time, so that only the orders of one window are held in
+        memory. The size of the window is configured on the instance.
+
+        The import starts from the update time of the last order imported
+        if there is a checkpoint for the store view, else from the last
+        order import time.
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param store_view: Browse record of store view
+        :param session: Session on the instance of store view
+        :param filter: Filters for listing orders apart from update time
+        :param context: Application context
+        :return: Generator of tuples of the end of the window and the list
+                 of orders updated in the window
+        """
+        checkpoint_obj = self.pool.get('magento.store_view.order_checkpoint')
+
+        order_api = session.get(magento.Order)
+
+        end = time.strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        start = checkpoint_obj.get_last_updated_at(
+            cursor, user, store_view.id, context
+        ) or store_view.last_order_import_time
+        window_hours = store_view.instance.order_import_window
+
+        if not start or not window_hours:
+            if start:
+                filter = dict(filter, updated_at={'gteq': start})
+            yield end, order_api.list(filter)
+            return
+
+        window_start = datetime.strptime(
+            start, DEFAULT_SERVER_DATETIME_FORMAT
+        )
+        last_end = datetime.strptime(end, DEFAULT_SERVER_DATETIME_FORMAT)
+        while True:
+            window_end = min(
+                window_start + timedelta(hours=window_hours), last_end
+            )
+            yield window_end.strftime(DEFAULT_SERVER_DATETIME_FORMAT), \
+                order_api.list(dict(filter, updated_at={
+                    'from': window_start.strftime(
+                        DEFAULT_SERVER_DATETIME_FORMAT
+                    ),
+                    'to': window_end.strftime(DEFAULT_SERVER_DATETIME_FORMAT),
+                }))
+            if window_end >= last_end:
+                break
+            window_start = window_end
+
     def export_orders_to_magento(self, cursor, user, store_view, context):
         """
         Export sale orders to magento for the current store view.
-        Export only those orders which are updated after last export time.
+        Export only those orders whose state changed since their last
+        export.
 
         :param cursor: Database cursor
         :param user: ID of current user
@@ -624,11 +1276,10 @@ class WebsiteStoreView(osv.Model):
         sale_obj = self.pool.get('sale.order')
 
         exported_sales = []
-        domain = [('magento_store_view', '=', store_view.id)]
-
-        # FIXME: Shitty openerp date comparison needs some magical
-        # logic to be implemented.
-        # TODO: Add date comparison or write date with last_order_export_time
+        domain = [
+            ('magento_store_view', '=', store_view.id),
+            ('magento_export_pending', '=', True),
+        ]
 
         order_ids = sale_obj.search(cursor, user, domain, context=context)
 
@@ -637,10 +1288,21 @@ class WebsiteStoreView(osv.Model):
                 DEFAULT_SERVER_DATETIME_FORMAT
             )
         }, context=context)
-        for sale_order in sale_obj.browse(cursor, user, order_ids):
-            exported_sales.append(sale_obj.export_order_status_to_magento(
-                cursor, user, sale_order, context
-            ))
+        if context is None:
+            context = {}
+
+        with job_session(store_view.instance, context):
+            for sale_order in sale_obj.browse(cursor, user, order_ids):
+                exported_sales.append(
+                    sale_obj.export_order_status_to_magento(
+                        cursor, user, sale_order, context
+                    )
+                )
+
+        if order_ids:
+            sale_obj.write(cursor, user, order_ids, {
+                'magento_export_pending': False,
+            }, context=context)
 
         return exported_sales
 
@@ -711,7 +1373,6 @@ class WebsiteStoreView(osv.Model):
         shipment_ids = shipment_obj.search(
             cursor, user, domain, context=context
         )
-        shipments = []
         if not shipment_ids:
             raise osv.except_osv(
                 _('Shipments Not Found!'),
@@ -721,46 +1382,50 @@ class WebsiteStoreView(osv.Model):
                 )
             )
 
-        for shipment in shipment_obj.browse(
-            cursor, user, shipment_ids, context
-        ):
-            shipments.append(shipment)
-            increment_id = shipment.sale_id.name[
-                len(instance.order_prefix): len(shipment.sale_id.name)
-            ]
-
-            try:
-                # FIXME This method expects the shipment to be made for all
-                # products in one picking. Split shipments is not supported yet
-                with magento.Shipment(
-                    instance.url, instance.api_user, instance.api_key
-                ) as shipment_api:
-                    shipment_increment_id = shipment_api.create(
-                        order_increment_id=increment_id, items_qty={}
-                    )
-                    shipment_obj.write(
-                        cursor, user, shipment.id, {
-                            'magento_increment_id': shipment_increment_id,
-                        }, context=context
-                    )
-
-                    # Rebrowse the record
-                    shipment = shipment_obj.browse(
-                        cursor, user, shipment.id, context=context
-                    )
-                    if store_view.export_tracking_information:
-                        self.export_tracking_info_to_magento(
-                            cursor, user, shipment, context
+        shipments = shipment_obj.browse(cursor, user, shipment_ids, context)
+        with job_session(instance, context) as session:
+            # FIXME This method expects the shipment to be made for all
+            # products in one picking. Split shipments is not supported yet
+            # The arguments are those sent by magento.Shipment.create, which
+            # notifies the customer by email
+            results = multicall(session.get(magento.Shipment), [
+                ['sales_order_shipment.create', [
+                    shipment.sale_id.name[len(instance.order_prefix):], {},
+                    '', True, False
+                ]] for shipment in shipments
+            ], SHIPMENT_BATCH_SIZE)
+
+            created = []
+            for shipment, result in zip(shipments, results):
+                if isinstance(result, xmlrpclib.Fault):
+                    if result.faultCode == 102:
+                        # A shipment already exists for this order, log
+                        # this detail and continue
+                        _logger.info(
+                            'Shipment for sale %s already exists on magento'
+                            % shipment.sale_id.name
+                        )
+                    else:
+                        _logger.error(
+                            'Shipment for sale %s could not be exported to '
+                            'magento: %s' % (
+                                shipment.sale_id.name, result.faultString
+                            )
                         )
-            except xmlrpclib.Fault, fault:
-                if fault.faultCode == 102:
-                    # A shipment already exists for this order, log this
-                    # detail and continue
-                    _logger.info(
-                        'Shipment for sale %s already exists on magento'
-                        % shipment.sale_id.name
-                    )
                     continue
+                shipment_obj.write(
+                    cursor, user, shipment.id, {
+                        'magento_increment_id': result,
+                    }, context=context
+                )
+                created.append(shipment.id)
+
+            if store_view.export_tracking_information and created:
+                self.export_tracking_info_of_shipments_to_magento(
+                    cursor, user, shipment_obj.browse(
+                        cursor, user, created, context
+                    ), context
+                )
 
         self.write(cursor, user, store_view.id, {
             'last_shipment_export_time': time.strftime(
@@ -768,7 +1433,9 @@ class WebsiteStoreView(osv.Model):
             )
         }, context=context)
 
-        return shipments
+        # Browsed again, as the records browsed before cache the values
+        # from before the export
+        return shipment_obj.browse(cursor, user, shipment_ids, context)
 
     def export_tracking_info_to_magento(
         self, cursor, user, shipment, context
@@ -780,7 +1447,25 @@ class WebsiteStoreView(osv.Model):
         :param user: ID of current user
         :param shipment: Browse record of shipment
         :param context: Dictionary of application context
-        :return: Shipment increment ID
+        :return: True if the tracking info was exported else False
+        """
+        return bool(self.export_tracking_info_of_shipments_to_magento(
+            cursor, user, [shipment], context
+        ))
+
+    def export_tracking_info_of_shipments_to_magento(
+        self, cursor, user, shipments, context
+    ):
+        """
+        Export tracking info to magento for all the shipments, in multiCall
+        requests
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param shipments: List of browse records of shipment
+        :param context: Dictionary of application context
+        :return: List of browse records of shipments whose tracking info
+                 was exported
         """
         magento_carrier_obj = self.pool.get('magento.instance.carrier')
         instance_obj = self.pool.get('magento.instance')
@@ -790,43 +1475,240 @@ class WebsiteStoreView(osv.Model):
             cursor, user, context['magento_instance'], context
         )
 
-        carriers = magento_carrier_obj.search(
-            cursor, user, [
-                ('instance', '=', instance.id),
-                ('carrier', '=', shipment.carrier_id.id)
-            ], context=context
+        carriers = magento_carrier_obj.get_carriers_by_openerp_carrier(
+            cursor, user, instance.id, context
         )
 
-        if not carriers:
-            _logger.error(
-                'No matching carrier has been configured on instance %s'
-                ' for the magento carrier/shipping method %s'
-                % (instance.name, shipment.carrier_id.name)
+        tracks = []
+        for shipment in shipments:
+            magento_carrier = carriers.get(shipment.carrier_id.id)
+            if not magento_carrier:
+                _logger.error(
+                    'No matching carrier has been configured on instance %s'
+                    ' for the magento carrier/shipping method %s'
+                    % (instance.name, shipment.carrier_id.name)
+                )
+                continue
+            tracks.append((shipment, magento_carrier))
+
+        # Add tracking info to the shipments on magento
+        with job_session(instance, context) as session:
+            results = multicall(session.get(magento.Shipment), [
+                ['sales_order_shipment.addTrack', [
+                    shipment.magento_increment_id,
+                    carrier.code,
+                    carrier.title,
+                    shipment.carrier_tracking_ref,
+                ]] for shipment, carrier in tracks
+            ], SHIPMENT_BATCH_SIZE)
+
+        exported = []
+        for (shipment, carrier), result in zip(tracks, results):
+            if isinstance(result, xmlrpclib.Fault):
+                _logger.error(
+                    'Tracking info of shipment %s could not be exported to '
+                    'magento: %s' % (shipment.name, result.faultString)
+                )
+                continue
+            exported.append(shipment)
+
+        if exported:
+            picking_obj.write(
+                cursor, user, map(int, exported), {
+                    'is_tracking_exported_to_magento': True
+                }, context=context
             )
+
+        return exported
+
+
+class OrderImportCheckpoint(osv.Model):
+    """Order Import Checkpoint
+
+    Keeps the highest update time (as on magento) of the orders imported
+    from a store view. It is written in the same transaction as the sales
+    imported with it, so an import which fails halfway resumes from the
+    last batch of sales committed.
+    """
+    _name = 'magento.store_view.order_checkpoint'
+    _description = 'Order Import Checkpoint'
+    _rec_name = 'store_view'
+
+    _columns = dict(
+        store_view=fields.many2one(
+            'magento.store.store_view', 'Store View', required=True,
+            readonly=True, select=True, ondelete='cascade',
+        ),
+        updated_at=fields.datetime(
+            'Update Time Of Last Imported Order', required=True,
+            readonly=True,
+        ),
+    )
+
+    _sql_constraints = [(
+        'store_view_unique', 'unique(store_view)',
+        'A store view can have only one order import checkpoint'
+    )]
+
+    def get_last_updated_at(self, cursor, user, store_view_id, context):
+        """
+        Returns the update time of the last order imported from the store
+        view
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param store_view_id: ID of store view
+        :param context: Application context
+        :return: Update time as string or None if nothing was imported yet
+        """
+        checkpoint_ids = self.search(cursor, user, [
+            ('store_view', '=', store_view_id)
+        ], context=context)
+
+        return checkpoint_ids and self.browse(
+            cursor, user, checkpoint_ids[0], context=context
+        ).updated_at or None
+
+    def advance(self, cursor, user, store_view_id, updated_at, context):
+        """
+        Moves the checkpoint of the store view to `updated_at`. The
+        checkpoint never moves back in time.
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param store_view_id: ID of store view
+        :param updated_at: Update time of the last order imported
+        :param context: Application context
+        """
+        checkpoint_ids = self.search(cursor, user, [
+            ('store_view', '=', store_view_id)
+        ], context=context)
+
+        if not checkpoint_ids:
+            self.create(cursor, user, {
+                'store_view': store_view_id,
+                'updated_at': updated_at,
+            }, context=context)
             return
 
-        carrier = magento_carrier_obj.browse(
-            cursor, user, carriers[0], context
+        checkpoint = self.browse(
+            cursor, user, checkpoint_ids[0], context=context
         )
+        if updated_at > checkpoint.updated_at:
+            self.write(cursor, user, checkpoint.id, {
+                'updated_at': updated_at,
+            }, context=context)
 
-        # Add tracking info to the shipment on magento
-        with magento.Shipment(
-            instance.url, instance.api_user, instance.api_key
-        ) as shipment_api:
-            shipment_increment_id = shipment_api.addtrack(
-                shipment.magento_increment_id,
-                carrier.code,
-                carrier.title,
-                shipment.carrier_tracking_ref,
-            )
 
-            picking_obj.write(
-                cursor, user, shipment.id, {
-                    'is_tracking_exported_to_magento': True
-                }, context=context
+class StoreTierPriceExport(osv.Model):
+    """Tier Price Export
+
+    Keeps a fingerprint of the tier prices of a product last exported to
+    a store, so that the export sends only the tier prices which changed.
+    """
+    _name = 'magento.store.tier_price_export'
+    _description = 'Tier Price Export'
+    _rec_name = 'product'
+
+    _columns = dict(
+        store=fields.many2one(
+            'magento.website.store', 'Magento Store', required=True,
+            readonly=True, select=True, ondelete='cascade',
+        ),
+        product=fields.many2one(
+            'product.product', 'Product', required=True, readonly=True,
+            ondelete='cascade',
+        ),
+        fingerprint=fields.char(
+            'Fingerprint', size=40, required=True, readonly=True,
+        ),
+    )
+
+    _sql_constraints = [(
+        'store_product_unique', 'unique(store, product)',
+        'A product can have only one tier price export in a store'
+    )]
+
+    def get_fingerprint(self, price_data):
+        """
+        Returns the fingerprint of the tier prices of a product
+
+        :param price_data: List of dictionaries of quantity and price
+        :return: Hexadecimal digest
+        """
+        return hashlib.sha1(json.dumps(sorted(
+            (tier['qty'], tier['price']) for tier in price_data
+        ))).hexdigest()
+
+    def get_fingerprints(self, cursor, user, store_id, context):
+        """
+        Returns the fingerprints of the tier prices last exported to the
+        store
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param store_id: ID of store
+        :param context: Application context
+        :return: Dictionary of fingerprints by product ID
+        """
+        record_ids = self.search(cursor, user, [
+            ('store', '=', store_id)
+        ], context=context)
+
+        return dict(
+            (record['product'][0], record['fingerprint'])
+            for record in self.read(
+                cursor, user, record_ids, ['product', 'fingerprint'],
+                context=context
             )
+        )
 
-        return shipment_increment_id
+    def record(self, cursor, user, store_id, fingerprints, context):
+        """
+        Records the fingerprints of the tier prices exported to the store
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param store_id: ID of store
+        :param fingerprints: Dictionary of fingerprints by product ID
+        :param context: Application context
+        """
+        if not fingerprints:
+            return
+
+        record_ids = self.search(cursor, user, [
+            ('store', '=', store_id),
+            ('product', 'in', fingerprints.keys()),
+        ], context=context)
+        for record in self.read(
+            cursor, user, record_ids, ['product'], context=context
+        ):
+            self.write(cursor, user, record['id'], {
+                'fingerprint': fingerprints.pop(record['product'][0]),
+            }, context=context)
+
+        for product_id, fingerprint in fingerprints.iteritems():
+            self.create(cursor, user, {
+                'store': store_id,
+                'product': product_id,
+                'fingerprint': fingerprint,
+            }, context=context)
+
+    def invalidate_pricelists(self, cursor, user, pricelist_ids, context):
+        """
+        Drops the fingerprints of the stores which sell on the pricelists,
+        so that all their tier prices are exported again
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param pricelist_ids: List of ids of pricelists
+        :param context: Application context
+        """
+        record_ids = self.search(cursor, user, [
+            ('store.shop.pricelist_id', 'in', pricelist_ids)
+        ], context=context)
+        if record_ids:
+            self.unlink(cursor, user, record_ids, context=context)
 
 
 class StorePriceTier(osv.Model):
@@ -7,16 +7,26 @@
     :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) Limited
     :license: AGPLv3, see LICENSE for more details.
 """
+import hashlib
+import json
+
 import magento
+import psycopg2
 
 from openerp.osv import fields, osv
 from openerp.tools.translate import _
 
+from .cache import RunCacheInvalidationMixin, cached
+from .session import job_session
+
 
-class MagentoWebsitePartner(osv.Model):
+class MagentoWebsitePartner(RunCacheInvalidationMixin, osv.Model):
     "Magento Website partner store"
     _name = 'magento.website.partner'
 
+    # Runs cache only the partners found, which new records do not change
+    _run_cache_invalidate_on_create = False
+
     _columns = dict(
         magento_id=fields.integer('Magento ID', readonly=True),
         website=fields.many2one(
@@ -25,46 +35,156 @@ class MagentoWebsitePartner(osv.Model):
         ),
         partner=fields.many2one(
             'res.partner', 'Partner', required=True, readonly=True
-        )
+        ),
+        email=fields.char(
+            'Email', size=240, readonly=True, select=True,
+            help="Email of the customer in lower case, used to find the "
+            "partner of guest customers",
+        ),
     )
 
-    def check_unique_partner(self, cursor, user, ids, context=None):
-        """Checks thats each partner should be unique in a website if it
-        does not have a magento ID of 0. magento_id of 0 means its a guest
-        cutsomers.
+    def _auto_init(self, cursor, context=None):
+        """
+        Each customer must be unique in a website, except guest customers
+        who all have a magento ID of 0. This is a partial unique index,
+        which an SQL constraint of the ORM cannot express.
 
         :param cursor: Database cursor
-        :param user: ID of current user
-        :param ids: IDs of records
         :param context: Application context
-        :return: True or False
         """
-        for magento_partner in self.browse(cursor, user, ids, context=context):
-            if magento_partner.magento_id != 0 and self.search(cursor, user, [
-                ('magento_id', '=', magento_partner.magento_id),
-                ('website', '=', magento_partner.website.id),
-                ('id', '!=', magento_partner.id),
-            ], context=context, count=True) > 0:
-                return False
-        return True
-
-    _constraints = [
-        (
-            check_unique_partner,
-            'Error: Customers should be unique for a website',
-            []
+        res = super(MagentoWebsitePartner, self)._auto_init(cursor, context)
+        cursor.execute(
+            'SELECT indexname FROM pg_indexes WHERE indexname = %s',
+            ('magento_website_partner_magento_id_website_unique', )
         )
-    ]
+        if not cursor.fetchone():
+            cursor.execute(
+                'CREATE UNIQUE INDEX '
+                'magento_website_partner_magento_id_website_unique '
+                'ON magento_website_partner (magento_id, website) '
+                'WHERE magento_id != 0'
+            )
+
+        # Guest customers imported before the email was kept
+        cursor.execute(
+            'UPDATE magento_website_partner AS store '
+            'SET email = lower(trim(partner.email)) '
+            'FROM res_partner AS partner '
+            'WHERE store.partner = partner.id AND store.email IS NULL '
+            'AND store.magento_id = 0 AND partner.email IS NOT NULL'
+        )
+        return res
 
 
 class Partner(osv.Model):
     "Partner"
     _inherit = 'res.partner'
 
+    def get_address_fingerprint(self, address_values):
+        """
+        Returns the fingerprint of an address. The values are compared
+        without case and surrounding spaces, and empty values are the same.
+
+        :param address_values: List of name, street, zip, city, phone, fax,
+                               country code and region of the address
+        :return: Hexadecimal digest
+        """
+        return hashlib.sha1(json.dumps([
+            (value or u'').strip().lower() for value in address_values
+        ])).hexdigest()
+
+    def get_magento_data_fingerprint(self, address_data):
+        """
+        Returns the fingerprint of an address sent by magento
+
+        :param address_data: Dictionary of address data from magento
+        :return: Hexadecimal digest
+        """
+        return self.get_address_fingerprint([
+            u' '.join([address_data['firstname'], address_data['lastname']]),
+            address_data['street'],
+            address_data['postcode'],
+            address_data['city'],
+            address_data['telephone'],
+            address_data['fax'],
+            address_data['country_id'],
+            address_data['region'],
+        ])
+
+    def get_magento_address_fingerprint(
+        self, cursor, user, ids, name, arg, context
+    ):
+        """Compute the fingerprint of the addresses
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param ids: IDs of records
+        :param name: Name of field
+        :param context: Application context
+        """
+        res = {}
+        for address in self.browse(cursor, user, ids, context=context):
+            res[address.id] = self.get_address_fingerprint([
+                address.name,
+                address.street,
+                address.zip,
+                address.city,
+                address.phone,
+                address.fax,
+                address.country_id and address.country_id.code,
+                address.state_id and address.state_id.name,
+            ])
+        return res
+
+    def _get_partners_of_states(self, cursor, user, ids, context=None):
+        """Return the IDs of the partners in the given states
+
+        Called by the trigger of the stored fingerprint, so self is the
+        state model.
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param ids: IDs of states
+        :param context: Application context
+        """
+        return self.pool.get('res.partner').search(
+            cursor, user, [('state_id', 'in', ids)],
+            context=dict(context or {}, active_test=False)
+        )
+
+    def _get_partners_of_countries(self, cursor, user, ids, context=None):
+        """Return the IDs of the partners in the given countries
+
+        Called by the trigger of the stored fingerprint, so self is the
+        country model.
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param ids: IDs of countries
+        :param context: Application context
+        """
+        return self.pool.get('res.partner').search(
+            cursor, user, [('country_id', 'in', ids)],
+            context=dict(context or {}, active_test=False)
+        )
+
     _columns = dict(
         magento_ids=fields.one2many(
             'magento.website.partner', 'partner', "Magento IDs", readonly=True
         ),
+        magento_address_fingerprint=fields.function(
+            get_magento_address_fingerprint, type='char', size=40,
+            string='Address Fingerprint', select=True, store={
+                'res.partner': (
+                    lambda self, cursor, user, ids, context=None: ids, [
+                        'name', 'street', 'zip', 'city', 'phone', 'fax',
+                        'country_id', 'state_id',
+                    ], 10
+                ),
+                'res.country.state': (_get_partners_of_states, ['name'], 10),
+                'res.country': (_get_partners_of_countries, ['code'], 10),
+            }
+        ),
     )
 
     def find_or_create_using_magento_id(
@@ -79,24 +199,109 @@ class Partner(osv.Model):
         :param context: Application context.
         :return: Browse record of record created/found
         """
+        magento_partner_obj = self.pool.get('magento.website.partner')
         instance_obj = self.pool.get('magento.instance')
 
+        key = (context['magento_website'], int(magento_id))
+        cache = context.get('magento_cache')
+        partner_ids = cache.get_many(
+            magento_partner_obj._name, [key]
+        ) if cache else {}
+        if partner_ids:
+            return self.browse(cursor, user, partner_ids[key], context)
+
         partner = self.find_using_magento_id(cursor, user, magento_id, context)
         if not partner:
             instance = instance_obj.browse(
                 cursor, user, context['magento_instance'], context=context
             )
 
-            with magento.Customer(
-                instance.url, instance.api_user, instance.api_key
-            ) as customer_api:
-                customer_data = customer_api.info(magento_id)
+            with job_session(instance, context) as session:
+                customer_data = session.get(magento.Customer).info(magento_id)
 
             partner = self.create_using_magento_data(
                 cursor, user, customer_data, context
             )
+
+        if cache:
+            cache.update(magento_partner_obj._name, {key: partner.id})
         return partner
 
+    def find_or_create_all_using_magento_ids(
+        self, cursor, user, magento_ids, context
+    ):
+        """
+        Find or create the partners for all the customer `magento_ids` at
+        once
+
+        The customers already known are found with a single query. The rest
+        are fetched from magento in a single filtered list call and the
+        partners are created from them. A customer which magento does not
+        list is left out of the result, the callers which need it fail when
+        they look it up on their own.
+
+        The partners found or created are remembered in the cache of the
+        import run, if there is one in context, so the lookups for the same
+        customers later in the run need no query.
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param magento_ids: List of customer IDs from magento
+        :param context: Application context
+        :return: Dictionary of browse records of partner by magento ID
+        """
+        magento_partner_obj = self.pool.get('magento.website.partner')
+        instance_obj = self.pool.get('magento.instance')
+
+        website_id = context['magento_website']
+        keys = set((website_id, int(magento_id)) for magento_id in magento_ids)
+
+        cache = context.get('magento_cache')
+        partner_ids = cache.get_many(
+            magento_partner_obj._name, keys
+        ) if cache else {}
+        keys -= set(partner_ids)
+
+        if keys:
+            record_ids = magento_partner_obj.search(cursor, user, [
+                ('magento_id', 'in', [magento_id for _, magento_id in keys]),
+                ('website', '=', website_id),
+            ], context=context)
+            for record in magento_partner_obj.read(
+                cursor, user, record_ids, ['magento_id', 'partner'],
+                context=context
+            ):
+                partner_ids[(website_id, record['magento_id'])] = \
+                    record['partner'][0]
+            keys -= set(partner_ids)
+
+        if keys:
+            instance = instance_obj.browse(
+                cursor, user, context['magento_instance'], context=context
+            )
+            with job_session(instance, context) as session:
+                customers_data = session.get(magento.Customer).list({
+                    'customer_id': {
+                        'in': [magento_id for _, magento_id in sorted(keys)]
+                    },
+                })
+
+            for customer_data in customers_data:
+                key = (website_id, int(customer_data['customer_id']))
+                if key not in keys or key in partner_ids:
+                    continue
+                partner_ids[key] = self.create_using_magento_data(
+                    cursor, user, customer_data, context
+                ).id
+
+        if cache:
+            cache.update(magento_partner_obj._name, partner_ids)
+
+        return dict(
+            (magento_id, self.browse(cursor, user, partner_id, context))
+            for (_, magento_id), partner_id in partner_ids.iteritems()
+        )
+
     def find_using_magento_id(self, cursor, user, magento_id, context):
         """
         Finds partner with magento id
@@ -162,23 +367,111 @@ class Partner(osv.Model):
                         to which the customer has to be linked
         :return: Browse record of record created
         """
-        partner_id = self.create(
-            cursor, user, {
-                'name': u' '.join(
-                    [customer_data['firstname'], customer_data['lastname']]
-                ),
-                'email': customer_data['email'],
-                'magento_ids': [
-                    (0, 0, {
-                        'magento_id': customer_data.get('customer_id', 0),
-                        'website': context['magento_website'],
-                    })
-                ],
-            }, context=context
-        )
+        # The unique index on the website store rejects a customer which
+        # already exists. If this transaction can see that partner, it is
+        # used. A partner committed by a concurrent import is not visible
+        # in the snapshot of this transaction, so the error is raised again
+        # and the import of the order is queued to be retried.
+        cursor.execute('SAVEPOINT magento_partner_create')
+        try:
+            partner_id = self.create(
+                cursor, user, {
+                    'name': u' '.join(
+                        [customer_data['firstname'], customer_data['lastname']]
+                    ),
+                    'email': customer_data['email'],
+                    'magento_ids': [
+                        (0, 0, {
+                            'magento_id': customer_data.get('customer_id', 0),
+                            'website': context['magento_website'],
+                            'email': self.normalize_email(
+                                customer_data['email']
+                            ),
+                        })
+                    ],
+                }, context=context
+            )
+        except psycopg2.IntegrityError:
+            cursor.execute('ROLLBACK TO SAVEPOINT magento_partner_create')
+            partner = self.find_using_magento_data(
+                cursor, user, customer_data, context
+            )
+            if not partner:
+                raise
+            return partner
+        cursor.execute('RELEASE SAVEPOINT magento_partner_create')
 
         return self.browse(cursor, user, partner_id, context)
 
+    def normalize_email(self, email):
+        """
+        Returns the `email` as it is compared to find guest customers
+
+        :param email: Email address
+        """
+        return email and email.strip().lower() or None
+
+    def find_or_create_guest_using_magento_data(
+        self, cursor, user, customer_data, context
+    ):
+        """
+        Finds or creates the partner of a guest customer
+
+        Magento has no ID for guests, so every order of a guest creates a new
+        partner. If the website in context merges guest customers, the
+        partner of an earlier guest with the same email in the website is
+        used instead.
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param customer_data: Dictionary of values for customer sent by magento
+        :param context: Application context. Contains the magento_website
+                        to which the customer has to be linked
+        :return: Browse record of record created/found
+        """
+        website_obj = self.pool.get('magento.instance.website')
+        magento_partner_obj = self.pool.get('magento.website.partner')
+
+        website_id = context['magento_website']
+        email = self.normalize_email(customer_data['email'])
+        merge = cached(
+            context, website_obj._name, ('merge_guest_customers', website_id),
+            lambda: website_obj.read(
+                cursor, user, website_id, ['merge_guest_customers'],
+                context=context
+            )['merge_guest_customers']
+        )
+        if not (merge and email):
+            return self.create_using_magento_data(
+                cursor, user, customer_data, context
+            )
+
+        key = ('guest', website_id, email)
+        cache = context.get('magento_cache')
+        partner_ids = cache.get_many(
+            magento_partner_obj._name, [key]
+        ) if cache else {}
+        if partner_ids:
+            return self.browse(cursor, user, partner_ids[key], context)
+
+        record_ids = magento_partner_obj.search(cursor, user, [
+            ('email', '=', email),
+            ('magento_id', '=', 0),
+            ('website', '=', website_id),
+        ], limit=1, context=context)
+        if record_ids:
+            partner = magento_partner_obj.browse(
+                cursor, user, record_ids[0], context=context
+            ).partner
+        else:
+            partner = self.create_using_magento_data(
+                cursor, user, customer_data, context
+            )
+
+        if cache:
+            cache.update(magento_partner_obj._name, {key: partner.id})
+        return partner
+
     def find_using_magento_data(self, cursor, user, customer_data, context):
         """
         Looks for the customer whose `customer_data` is sent by magento against
@@ -222,23 +515,27 @@ class Partner(osv.Model):
         :param context: Application context.
         :return: Browse record of address created/found
         """
-        for address in parent.child_ids + [parent]:
-            if self.match_address_with_magento_data(
-                cursor, user, address, address_data
-            ):
-                break
-        else:
-            address = self.create_address_as_partner_using_magento_data(
-                cursor, user, address_data, parent, context
-            )
+        # The addresses are matched by their fingerprint, which is indexed
+        address_ids = self.search(cursor, user, [
+            (
+                'magento_address_fingerprint', '=',
+                self.get_magento_data_fingerprint(address_data)
+            ),
+            '|', ('parent_id', '=', parent.id), ('id', '=', parent.id),
+        ], limit=1, context=context)
+
+        if address_ids:
+            return self.browse(cursor, user, address_ids[0], context=context)
 
-        return address
+        return self.create_address_as_partner_using_magento_data(
+            cursor, user, address_data, parent, context
+        )
 
     def match_address_with_magento_data(
         self, cursor, user, address, address_data
     ):
         """Match the `address` in openerp with the `address_data` from magento
-        If everything matches exactly, return True, else return False
+        If the fingerprints of both match, return True, else return False
 
         :param cursor: Database cursor
         :param user: ID of current user
@@ -246,26 +543,8 @@ class Partner(osv.Model):
         :param address_data: Dictionary of address data from magento
         :return: True if address matches else False
         """
-        # Check if the name matches
-        if address.name != u' '.join(
-            [address_data['firstname'], address_data['lastname']]
-        ):
-            return False
-
-        if not all([
-            (address.street or None) == address_data['street'],
-            (address.zip or None) == address_data['postcode'],
-            (address.city or None) == address_data['city'],
-            (address.phone or None) == address_data['telephone'],
-            (address.fax or None) == address_data['fax'],
-            (address.country_id and address.country_id.code or None) ==
-                address_data['country_id'],
-            (address.state_id and address.state_id.name or None) ==
-                address_data['region']
-        ]):
-            return False
-
-        return True
+        return address.magento_address_fingerprint == \
+            self.get_magento_data_fingerprint(address_data)
 
     def create_address_as_partner_using_magento_data(
         self, cursor, user, address_data, parent, context
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+    pricelist
+
+    Pricelist
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: AGPLv3, see LICENSE for more details.
+"""
+from openerp.osv import osv
+
+from .cache import RunCache
+
+
+class PricelistChangeMixin(object):
+    """
+    Invalidates the tier prices computed and exported to magento from the
+    pricelists changed
+
+    The models using this must define
+    ``get_pricelist_ids(cursor, user, ids, context)``, which returns the IDs
+    of the pricelists of the records with `ids`.
+    """
+
+    def invalidate_tier_prices(self, cursor, user, ids, context):
+        """
+        Drops the tier prices computed from and exported for the pricelists
+        of the records
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param ids: List of ids of records
+        :param context: Application context
+        """
+        RunCache.invalidate('product.pricelist.version')
+
+        pricelist_ids = self.get_pricelist_ids(cursor, user, ids, context)
+        if pricelist_ids:
+            self.pool.get('magento.store.tier_price_export').\
+                invalidate_pricelists(cursor, user, pricelist_ids, context)
+
+    def create(self, cursor, user, values, context=None):
+        record_id = super(PricelistChangeMixin, self).create(
+            cursor, user, values, context
+        )
+        self.invalidate_tier_prices(cursor, user, [record_id], context)
+        return record_id
+
+    def write(self, cursor, user, ids, values, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        # The records may move to other pricelists
+        self.invalidate_tier_prices(cursor, user, ids, context)
+        result = super(PricelistChangeMixin, self).write(
+            cursor, user, ids, values, context
+        )
+        self.invalidate_tier_prices(cursor, user, ids, context)
+        return result
+
+    def unlink(self, cursor, user, ids, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        self.invalidate_tier_prices(cursor, user, ids, context)
+        return super(PricelistChangeMixin, self).unlink(
+            cursor, user, ids, context
+        )
+
+
+class Pricelist(PricelistChangeMixin, osv.Model):
+    "Pricelist"
+    _inherit = 'product.pricelist'
+
+    def get_pricelist_ids(self, cursor, user, ids, context):
+        return ids
+
+
+class PricelistVersion(PricelistChangeMixin, osv.Model):
+    "Pricelist Version"
+    _inherit = 'product.pricelist.version'
+
+    def get_pricelist_ids(self, cursor, user, ids, context):
+        return list(set(
+            version['pricelist_id'][0] for version in self.read(
+                cursor, user, ids, ['pricelist_id'], context=context
+            ) if version['pricelist_id']
+        ))
+
+
+class PricelistItem(PricelistChangeMixin, osv.Model):
+    "Pricelist Item"
+    _inherit = 'product.pricelist.item'
+
+    def get_pricelist_ids(self, cursor, user, ids, context):
+        version_obj = self.pool.get('product.pricelist.version')
+
+        return version_obj.get_pricelist_ids(cursor, user, list(set(
+            item['price_version_id'][0] for item in self.read(
+                cursor, user, ids, ['price_version_id'], context=context
+            ) if item['price_version_id']
+        )), context)
@@ -5,13 +5,27 @@
     :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) LTD
     :license: AGPLv3, see LICENSE for more details
 '''
+import logging
+import xmlrpclib
+
 import magento
 from openerp.osv import fields, osv
+from openerp.tools import float_compare
 from openerp.tools.translate import _
 import openerp.addons.decimal_precision as dp
 
+from .api import multicall
+from .cache import RunCacheInvalidationMixin, cached, count
+from .session import job_session
+
+
+_logger = logging.getLogger(__name__)
+
+#: Maximum number of product details fetched in one multiCall request
+INFO_BATCH_SIZE = 50
 
-class Category(osv.Model):
+
+class Category(RunCacheInvalidationMixin, osv.Model):
     """Product Category
     """
     _inherit = 'product.category'
@@ -28,23 +42,129 @@ class Category(osv.Model):
     ):
         """Create the categories from the category tree
 
+        The tree is walked level by level without recursion. The categories
+        already imported for the instance are loaded in one query and only
+        the missing ones are created. The ORM places each new category in
+        the parent store as it is created, so the rest of the categories
+        are not recomputed.
+
         :param cursor: Database cursor
         :param user: ID of current user
         :param category_tree: Category Tree from magento
         :param context: Application context
         """
-        # Create the root
-        root_categ = self.find_or_create_using_magento_data(
-            cursor, user, category_tree, context=context
+        category_ids = self.get_magento_category_ids(cursor, user, context)
+
+        # Each level is a list of nodes with the openerp ID of their parent
+        level = [(category_tree, None)]
+        while level:
+            next_level = []
+            for node, parent in level:
+                magento_id = int(node['category_id'])
+                if magento_id not in category_ids:
+                    category_ids[magento_id] = self.create_using_magento_data(
+                        cursor, user, node, parent, context
+                    ).id
+                next_level.extend(
+                    (child, category_ids[magento_id])
+                    for child in node['children']
+                )
+            level = next_level
+
+    def get_magento_category_ids(self, cursor, user, context):
+        """
+        Get the categories imported for the instance in context
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param context: Application context
+        :returns: Dictionary of openerp IDs of category by magento ID
+        """
+        magento_category_obj = self.pool.get(
+            'magento.instance.product_category'
         )
-        for child in category_tree['children']:
-            self.find_or_create_using_magento_data(
-                cursor, user, child, parent=root_categ.id, context=context
+
+        record_ids = magento_category_obj.search(cursor, user, [
+            ('instance', '=', context['magento_instance'])
+        ], context=context)
+        return dict(
+            (record['magento_id'], record['category'][0])
+            for record in magento_category_obj.read(
+                cursor, user, record_ids, ['magento_id', 'category'],
+                context=context
             )
-            if child['children']:
-                self.create_tree_using_magento_data(
-                    cursor, user, child, context
-                )
+        )
+
+    def find_or_create_id_using_magento_id(
+        self, cursor, user, magento_id, context
+    ):
+        """
+        Find or create the category for a product being imported
+
+        The categories imported for the instance are looked up in an index
+        loaded once for the import run. On a miss, the whole category tree
+        of the website is imported, once for the run, instead of the single
+        category. Without a run cache in context this is the same as
+        :meth:`find_or_create_using_magento_id`.
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param magento_id: Category ID from magento
+        :param context: Application context
+        :returns: ID of category found/created
+        """
+        magento_category_obj = self.pool.get(
+            'magento.instance.product_category'
+        )
+
+        if not context.get('magento_cache'):
+            return self.find_or_create_using_magento_id(
+                cursor, user, magento_id, context=context
+            ).id
+
+        def get_index():
+            return cached(
+                context, magento_category_obj._name,
+                context['magento_instance'],
+                lambda: self.get_magento_category_ids(cursor, user, context)
+            )
+
+        magento_id = int(magento_id)
+        if magento_id not in get_index():
+            cached(
+                context, 'magento.category_tree', context['magento_website'],
+                lambda: self.import_tree_of_website(cursor, user, context)
+            )
+            if magento_id not in get_index():
+                # Not in the tree of the website
+                return self.find_or_create_using_magento_id(
+                    cursor, user, magento_id, context=context
+                ).id
+
+        return get_index()[magento_id]
+
+    def import_tree_of_website(self, cursor, user, context):
+        """
+        Import the category tree of the website in context
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param context: Application context
+        """
+        website_obj = self.pool.get('magento.instance.website')
+
+        website = website_obj.browse(
+            cursor, user, context['magento_website'], context=context
+        )
+        with job_session(website.instance, context) as session:
+            category_tree = session.get(magento.Category).tree(
+                website.magento_root_category_id
+            )
+
+        self.create_tree_using_magento_data(
+            cursor, user, category_tree, context
+        )
+        return True
 
     def find_or_create_using_magento_data(
         self, cursor, user, category_data, parent=None, context=None
@@ -169,7 +289,7 @@ class Category(osv.Model):
         return self.browse(cursor, user, category_id, context=context)
 
 
-class MagentoInstanceCategory(osv.Model):
+class MagentoInstanceCategory(RunCacheInvalidationMixin, osv.Model):
     """Magento Instance - Product category store
 
     This model keeps a record of a category's association with an instance and
@@ -248,11 +368,8 @@ class Product(osv.Model):
                 cursor, user, context['magento_website'], context=context
             )
 
-            instance = website.instance
-            with magento.Product(
-                instance.url, instance.api_user, instance.api_key
-            ) as product_api:
-                product_data = product_api.info(magento_id)
+            with job_session(website.instance, context) as session:
+                product_data = session.get(magento.Product).info(magento_id)
 
             product = self.create_using_magento_data(
                 cursor, user, product_data, context
@@ -260,6 +377,91 @@ class Product(osv.Model):
 
         return product
 
+    def find_or_create_all_using_magento_ids(
+        self, cursor, user, magento_ids, context
+    ):
+        """
+        Find or create the products for all the `magento_ids` at once
+
+        The products already known are found with a single query. The
+        details of the rest are fetched from magento in multiCall requests
+        and the products are created from them. A product whose details
+        could not be fetched is logged and left out of the result, the
+        callers which need it fail when they look it up on their own.
+
+        The products found or created are remembered in the cache of the
+        import run, if there is one in context, so the lookups for the same
+        products later in the run need no query.
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param magento_ids: List of product IDs from magento
+        :param context: Application context
+        :returns: Dictionary of browse records of product by magento ID
+        """
+        website_obj = self.pool.get('magento.instance.website')
+        magento_product_obj = self.pool.get('magento.website.product')
+
+        website_id = context['magento_website']
+        keys = set((website_id, int(magento_id)) for magento_id in magento_ids)
+
+        cache = context.get('magento_cache')
+        product_ids = cache.get_many(
+            magento_product_obj._name, keys
+        ) if cache else {}
+        keys -= set(product_ids)
+
+        if keys:
+            record_ids = magento_product_obj.search(cursor, user, [
+                ('magento_id', 'in', [magento_id for _, magento_id in keys]),
+                ('website', '=', website_id),
+            ], context=context)
+            for record in magento_product_obj.read(
+                cursor, user, record_ids, ['magento_id', 'product'],
+                context=context
+            ):
+                product_ids[(website_id, record['magento_id'])] = \
+                    record['product'][0]
+            keys -= set(product_ids)
+
+        if keys:
+            website = website_obj.browse(
+                cursor, user, website_id, context=context
+            )
+            calls = [
+                ['catalog_product.info', [magento_id]]
+                for _, magento_id in sorted(keys)
+            ]
+            with job_session(website.instance, context) as session:
+                results = multicall(
+                    session.get(magento.Product), calls, INFO_BATCH_SIZE
+                )
+
+            for product_data in results:
+                if isinstance(product_data, xmlrpclib.Fault):
+                    _logger.warning(
+                        'Product details could not be fetched from magento: '
+                        '%s' % product_data.faultString
+                    )
+                    continue
+                product = self.create_using_magento_data(
+                    cursor, user, product_data, context
+                )
+                product_ids[
+                    (website_id, int(product_data['product_id']))
+                ] = product.id
+
+        if cache:
+            # Only the products found are cached. A product created later
+            # in the run does not change these, so only a write or unlink
+            # on the store needs to drop them.
+            cache.update(magento_product_obj._name, product_ids)
+
+        return dict(
+            (magento_id, self.browse(cursor, user, product_id, context))
+            for (_, magento_id), product_id in product_ids.iteritems()
+        )
+
     def find_using_magento_id(self, cursor, user, magento_id, context):
         """
         Finds product using magento id
@@ -328,13 +530,18 @@ class Product(osv.Model):
         """
         Updates catalog from magento to openerp
 
+        Without `ids`, as on cron, only the products changed on magento
+        since the last update are updated on all websites.
+
         :param cursor: Database cursor
         :param user: ID of current user
-        :param ids: List of ids of website
+        :param ids: List of ids of products
         :param context: Application context
         """
         if not ids:
-            ids = self.search(cursor, user, [], context)
+            return self.pool.get('magento.instance.website').update_catalog(
+                cursor, user, context=context
+            )
 
         for product in self.browse(cursor, user, ids, context):
             self.update_from_magento(
@@ -408,10 +615,34 @@ class Product(osv.Model):
         :returns: Browse record of product updated
         """
         product_values = self.extract_product_values_from_data(product_data)
-        self.write(cursor, user, product.id, product_values, context=context)
+        precision = self.pool.get('decimal.precision').precision_get(
+            cursor, user, 'Product Price'
+        )
+
+        def is_changed(name, value):
+            if name == 'list_price':
+                # Prices are stored rounded to their precision
+                return float_compare(
+                    product[name], value, precision_digits=precision
+                )
+            return (product[name] or False) != (value or False)
+
+        # Only the values which changed are written. Writing the same
+        # values again still triggers the recomputation and tracking of
+        # the product.
+        changed_values = dict(
+            (name, value) for name, value in product_values.iteritems()
+            if is_changed(name, value)
+        )
+        if not changed_values:
+            count(context, 'products_skipped')
+            return product
+
+        self.write(cursor, user, product.id, changed_values, context=context)
+        count(context, 'products_written')
 
-        # Rebrowse the record
-        product = self.browse(cursor, user, product.id, context=context)
+        # Drop the stale values cached on the record
+        product.refresh()
 
         return product
 
@@ -433,14 +664,16 @@ class Product(osv.Model):
         # If not category is found, put product under unclassified category
         # which is created by default data
         if product_data.get('categories'):
-            category_id = category_obj.find_or_create_using_magento_id(
-                cursor, user, int(product_data['categories'][0]),
-                context=context
-            ).id
+            category_id = category_obj.find_or_create_id_using_magento_id(
+                cursor, user, int(product_data['categories'][0]), context
+            )
         else:
-            category_id, = category_obj.search(cursor, user, [
-                ('name', '=', 'Unclassified Magento Products')
-            ], context=context)
+            category_id, = cached(
+                context, category_obj._name, 'unclassified',
+                lambda: category_obj.search(cursor, user, [
+                    ('name', '=', 'Unclassified Magento Products')
+                ], context=context)
+            )
 
         product_values = self.extract_product_values_from_data(product_data)
         product_values.update({
@@ -565,7 +798,7 @@ class Product(osv.Model):
         return product
 
 
-class MagentoWebsiteProduct(osv.Model):
+class MagentoWebsiteProduct(RunCacheInvalidationMixin, osv.Model):
     """Magento Website - Product store
 
     This model keeps a record of a product's association with a website and
@@ -574,6 +807,9 @@ class MagentoWebsiteProduct(osv.Model):
     _name = 'magento.website.product'
     _description = 'Magento Website - Product store'
 
+    # Runs cache only the products found, which new records do not change
+    _run_cache_invalidate_on_create = False
+
     _columns = dict(
         magento_id=fields.integer(
             'Magento ID', required=True, select=True,
@@ -585,7 +821,16 @@ class MagentoWebsiteProduct(osv.Model):
         product=fields.many2one(
             'product.product', 'Product', readonly=True,
             required=True, select=True
-        )
+        ),
+        exported_qty=fields.float(
+            'Last Exported Quantity', readonly=True,
+            digits_compute=dp.get_precision('Product Unit of Measure'),
+        ),
+        exported_is_in_stock=fields.char(
+            'Last Exported Stock Status', size=1, readonly=True,
+            help="Stock status last exported to magento. This is empty if the "
+            "stock of product has never been exported",
+        ),
     )
 
     _sql_constraints = [
@@ -637,7 +882,6 @@ class ProductPriceTier(osv.Model):
         :param name: Nameo of field
         :param context: Application context
         """
-        pricelist_obj = self.pool.get('product.pricelist')
         store_obj = self.pool.get('magento.website.store')
 
         res = {}
@@ -645,16 +889,16 @@ class ProductPriceTier(osv.Model):
         if not context.get('magento_store'):
             return res
 
-        for tier in self.browse(cursor, user, ids, context=context):
-            store = store_obj.browse(
-                cursor, user, context['magento_store'], context=context
-            )
-            res[tier.id] = pricelist_obj.price_get(
-                cursor, user, [store.shop.pricelist_id.id], tier.product.id,
-                tier.quantity, context={
-                    'uom': store.website.default_product_uom.id
-                }
-            )[store.shop.pricelist_id.id]
+        store = store_obj.browse(
+            cursor, user, context['magento_store'], context=context
+        )
+        tiers = self.browse(cursor, user, ids, context=context)
+        prices = store_obj.get_tier_prices(cursor, user, store, [
+            (tier.product.id, tier.quantity) for tier in tiers
+        ], context)
+
+        for tier in tiers:
+            res[tier.id] = prices[(tier.product.id, tier.quantity)]
         return res
 
     _columns = dict(
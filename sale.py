@@ -7,14 +7,26 @@
     :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Limited
     :license: AGPLv3, see LICENSE for more details.
 """
+import json
+import logging
+import time
+import traceback
 import xmlrpclib
+from datetime import datetime, timedelta
 
 import magento
 from openerp.osv import fields, osv
+from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
 from openerp.tools.translate import _
 
+from .cache import RunCache, RunCacheInvalidationMixin, cached
+from .session import job_session
 
-class MagentoOrderState(osv.Model):
+
+_logger = logging.getLogger(__name__)
+
+
+class MagentoOrderState(RunCacheInvalidationMixin, osv.Model):
     """Magento - OpenERP Order State map
 
     This model stores a map of order states between OpenERP and Magento.
@@ -128,6 +140,11 @@ class Sale(osv.Model):
         magento_store_view=fields.many2one(
             'magento.store.store_view', 'Store View', readonly=True,
         ),
+        magento_export_pending=fields.boolean(
+            'Magento Export Pending', readonly=True, select=True,
+            help="The state of this order changed since its status was last "
+            "exported to magento",
+        ),
     )
 
     _sql_constraints = [(
@@ -135,6 +152,27 @@ class Sale(osv.Model):
         'A sale must be unique in an instance'
     )]
 
+    def write(self, cursor, user, ids, values, context=None):
+        """
+        Marks the magento orders whose state changes as pending to be
+        exported to magento
+        """
+        result = super(Sale, self).write(cursor, user, ids, values, context)
+
+        if 'state' in values:
+            if isinstance(ids, (int, long)):
+                ids = [ids]
+            pending_ids = self.search(cursor, user, [
+                ('id', 'in', ids),
+                ('magento_id', '>', 0),
+            ], context=context)
+            if pending_ids:
+                super(Sale, self).write(cursor, user, pending_ids, {
+                    'magento_export_pending': True,
+                }, context)
+
+        return result
+
     def check_store_view_instance(self, cursor, user, ids, context=None):
         """
         Checks if instance of store view is same as instance of sale order
@@ -203,6 +241,30 @@ class Sale(osv.Model):
             cursor, user, sale_ids[0], context
         ) or None
 
+    def get_imported_magento_ids(self, cursor, user, order_ids, context):
+        """
+        Find which of the given magento orders are already imported
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param order_ids: List of magento order IDs
+        :param context: Application context
+        :returns: Set of the magento IDs of orders already imported
+        """
+        if not order_ids:
+            return set()
+
+        sale_ids = self.search(cursor, user, [
+            ('magento_id', 'in', map(int, order_ids)),
+            ('magento_instance', '=', context.get('magento_instance'))
+        ], context=context)
+
+        return set(
+            sale['magento_id'] for sale in self.read(
+                cursor, user, sale_ids, ['magento_id'], context=context
+            )
+        )
+
     def find_or_create_using_magento_increment_id(
         self, cursor, user, order_increment_id, context
     ):
@@ -331,7 +393,7 @@ class Sale(osv.Model):
                 cursor, user, order_data['customer_id'], context
             )
         else:
-            partner = partner_obj.create_using_magento_data(
+            partner = partner_obj.find_or_create_guest_using_magento_data(
                 cursor, user, {
                     'firstname': order_data['customer_firstname'],
                     'lastname': order_data['customer_lastname'],
@@ -393,6 +455,11 @@ class Sale(osv.Model):
             cursor, user, sale, order_data['state'], context
         )
 
+        # The state came from magento, there is nothing to export yet
+        self.write(cursor, user, [sale.id], {
+            'magento_export_pending': False,
+        }, context=context)
+
         return sale
 
     def get_item_line_data_using_magento_data(
@@ -411,6 +478,13 @@ class Sale(osv.Model):
         product_obj = self.pool.get('product.product')
         bom_obj = self.pool.get('mrp.bom')
 
+        # Resolve the products of all the items, including the components
+        # of bundles, at once
+        products = product_obj.find_or_create_all_using_magento_ids(
+            cursor, user, [item['product_id'] for item in order_data['items']],
+            context
+        )
+
         line_data = []
         for item in order_data['items']:
             if not item['parent_item_id']:
@@ -429,10 +503,12 @@ class Sale(osv.Model):
                     'magento_notes': item['product_options'],
                     'type': 'make_to_order',
                     'tax_id': [(6, 0, taxes)],
-                    'product_id':
+                    'product_id': (
+                        products.get(int(item['product_id'])) or
                         product_obj.find_or_create_using_magento_id(
                             cursor, user, item['product_id'],
                             context=context
+                        )
                     ).id
                 }
                 line_data.append((0, 0, values))
@@ -465,10 +541,14 @@ class Sale(osv.Model):
 
         # Magento does not return the name of tax
         # First try matching with the percent
-        tax_ids = tax_obj.search(cursor, user, [
-            ('amount', '=', float(item_data['tax_percent']) / 100),
-            ('used_on_magento', '=', True)
-        ], context=context)
+        amount = float(item_data['tax_percent']) / 100
+        tax_ids = cached(
+            context, 'account.tax', ('amount', amount),
+            lambda: tax_obj.search(cursor, user, [
+                ('amount', '=', amount),
+                ('used_on_magento', '=', True)
+            ], context=context)
+        )
 
         # FIXME This will fail in the case of bundle products as tax comes
         # comes with the children and not with parent
@@ -488,10 +568,13 @@ class Sale(osv.Model):
 
         # Magento does not return the name of tax or rate
         # We can match only using the field set on tax in openerp itself
-        tax_ids = tax_obj.search(cursor, user, [
-            ('apply_on_magento_shipping', '=', True),
-            ('used_on_magento', '=', True)
-        ], context=context)
+        tax_ids = cached(
+            context, 'account.tax', 'shipping',
+            lambda: tax_obj.search(cursor, user, [
+                ('apply_on_magento_shipping', '=', True),
+                ('used_on_magento', '=', True)
+            ], context=context)
+        )
 
         return tax_ids
 
@@ -561,25 +644,13 @@ class Sale(osv.Model):
         :param context: Application context
         """
         # TODO: Improve this method for invoicing and shipping etc
-        magento_order_state_obj = self.pool.get('magento.order_state')
-
-        state_ids = magento_order_state_obj.search(cursor, user, [
-            ('code', '=', magento_state),
-            ('instance', '=', context['magento_instance'])
-        ])
-
-        if not state_ids:
-            raise osv.except_osv(
-                _('Order state not found!'),
-                _('Order state not found/mapped in OpenERP! '
-                  'Please import order states on instance'
-                 )
+        openerp_state = cached(
+            context, 'magento.order_state',
+            (context['magento_instance'], magento_state),
+            lambda: self.get_openerp_state(
+                cursor, user, magento_state, context
             )
-
-        state = magento_order_state_obj.browse(
-            cursor, user, state_ids[0], context=context
         )
-        openerp_state = state.openerp_state
 
         # If order is canceled, just cancel it
         if openerp_state == 'cancel':
@@ -595,6 +666,35 @@ class Sale(osv.Model):
         if openerp_state in ['closed', 'complete']:
             self.action_done(cursor, user, [sale.id], context)
 
+    def get_openerp_state(self, cursor, user, magento_state, context):
+        """Find the state in openerp mapped to the magento state for the
+        instance in context
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param magento_state: State on magento
+        :param context: Application context
+        :return: OpenERP state mapped to the magento state
+        """
+        magento_order_state_obj = self.pool.get('magento.order_state')
+
+        state_ids = magento_order_state_obj.search(cursor, user, [
+            ('code', '=', magento_state),
+            ('instance', '=', context['magento_instance'])
+        ])
+
+        if not state_ids:
+            raise osv.except_osv(
+                _('Order state not found!'),
+                _('Order state not found/mapped in OpenERP! '
+                  'Please import order states on instance'
+                 )
+            )
+
+        return magento_order_state_obj.browse(
+            cursor, user, state_ids[0], context=context
+        ).openerp_state
+
     def export_order_status_to_magento(self, cursor, user, sale, context):
         """
         Export order status to magento.
@@ -615,10 +715,8 @@ class Sale(osv.Model):
             # order status change due to its workflow constraints.
             # TODO: Find a better way to do it
             try:
-                with magento.Order(
-                    instance.url, instance.api_user, instance.api_key
-                ) as order_api:
-                    order_api.cancel(increment_id)
+                with job_session(instance, context) as session:
+                    session.get(magento.Order).cancel(increment_id)
             except xmlrpclib.Fault, f:
                 if f.faultCode == 103:
                     return sale
@@ -628,7 +726,7 @@ class Sale(osv.Model):
         return sale
 
 
-class MagentoInstanceCarrier(osv.Model):
+class MagentoInstanceCarrier(RunCacheInvalidationMixin, osv.Model):
     "Magento Instance Carrier"
 
     _name = 'magento.instance.carrier'
@@ -647,6 +745,35 @@ class MagentoInstanceCarrier(osv.Model):
         'Shipping method must be unique in instance'
     )]
 
+    def get_carriers_by_openerp_carrier(
+        self, cursor, user, instance_id, context
+    ):
+        """
+        Returns the magento carriers of the instance mapped to carriers in
+        openerp. The mapping is loaded once for the run if there is a run
+        cache in context.
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param instance_id: ID of magento instance
+        :param context: Application context
+        :return: Dictionary of browse records of magento carrier by ID of
+                 delivery carrier
+        """
+        def get_carriers():
+            carrier_ids = self.search(cursor, user, [
+                ('instance', '=', instance_id),
+                ('carrier', '!=', False),
+            ], context=context)
+            carriers = {}
+            for carrier in self.browse(
+                cursor, user, carrier_ids, context=context
+            ):
+                carriers.setdefault(carrier.carrier.id, carrier)
+            return carriers
+
+        return cached(context, self._name, instance_id, get_carriers)
+
     def create_all_using_magento_data(
         self, cursor, user, magento_data, context
     ):
@@ -756,3 +883,181 @@ class CustomerShipment(osv.Model):
             'Customer shipment should be unique in magento instance'
         ),
     ]
+
+
+class MagentoImportFailure(osv.Model):
+    """Magento Order Import Failure
+
+    Orders from magento which could not be imported. Each failed order is
+    imported again by a cron, with the delay between attempts doubling
+    after every failed attempt.
+    """
+    _name = 'magento.import.failure'
+    _description = 'Magento Order Import Failure'
+    _rec_name = 'increment_id'
+    _order = 'next_attempt'
+
+    #: Delay before the first retry, in minutes
+    RETRY_DELAY = 15
+
+    #: Maximum delay between two attempts, in minutes
+    MAX_RETRY_DELAY = 24 * 60
+
+    _columns = dict(
+        increment_id=fields.char(
+            'Order Increment ID', size=50, readonly=True, select=True
+        ),
+        store_view=fields.many2one(
+            'magento.store.store_view', 'Store View', required=True,
+            readonly=True, ondelete='cascade',
+        ),
+        payload=fields.text('Order Data', readonly=True),
+        traceback=fields.text('Traceback', readonly=True),
+        attempts=fields.integer('Attempts', readonly=True),
+        next_attempt=fields.datetime(
+            'Next Attempt', readonly=True, select=True
+        ),
+        state=fields.selection([
+            ('pending', 'Pending'),
+            ('done', 'Imported'),
+        ], 'State', readonly=True, select=True),
+    )
+
+    _defaults = dict(
+        attempts=lambda *a: 1,
+        state=lambda *a: 'pending',
+    )
+
+    def import_order(self, cursor, user, order_data, context):
+        """
+        Find or create the sale for `order_data` in a savepoint of its own.
+        If the import fails only the changes made for this order are rolled
+        back and the order is queued to be retried later.
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param order_data: Order Data from magento
+        :param context: Application context
+        :return: Browse record of sale order found/created or None if the
+                 import failed
+        """
+        sale_obj = self.pool.get('sale.order')
+
+        cursor.execute('SAVEPOINT magento_order_import')
+        try:
+            sale = sale_obj.find_or_create_using_magento_data(
+                cursor, user, order_data, context
+            )
+        except Exception:
+            cursor.execute('ROLLBACK TO SAVEPOINT magento_order_import')
+            # The records created for the order are gone, and so must be
+            # anything cached about them
+            if context.get('magento_cache'):
+                context['magento_cache'].clear()
+            _logger.exception(
+                'Order %s could not be imported from magento'
+                % order_data['increment_id']
+            )
+            self.record(
+                cursor, user, order_data, traceback.format_exc(), context
+            )
+            return None
+
+        cursor.execute('RELEASE SAVEPOINT magento_order_import')
+        return sale
+
+    def record(self, cursor, user, order_data, error, context):
+        """
+        Records a failed attempt to import the order
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param order_data: Order Data from magento
+        :param error: Traceback of the failure
+        :param context: Application context. Contains the store view from
+                        which the order was imported
+        :return: ID of the failure record
+        """
+        failure_ids = self.search(cursor, user, [
+            ('increment_id', '=', order_data['increment_id']),
+            ('store_view', '=', context['magento_store_view']),
+            ('state', '=', 'pending'),
+        ], context=context)
+
+        if not failure_ids:
+            return self.create(cursor, user, {
+                'increment_id': order_data['increment_id'],
+                'store_view': context['magento_store_view'],
+                'payload': json.dumps(order_data),
+                'traceback': error,
+                'attempts': 1,
+                'next_attempt': self.get_next_attempt_time(1),
+            }, context=context)
+
+        failure = self.browse(cursor, user, failure_ids[0], context=context)
+        self.write(cursor, user, failure.id, {
+            'payload': json.dumps(order_data),
+            'traceback': error,
+            'attempts': failure.attempts + 1,
+            'next_attempt': self.get_next_attempt_time(failure.attempts + 1),
+        }, context=context)
+        return failure.id
+
+    def get_next_attempt_time(self, attempts):
+        """
+        Returns the time of the next attempt after `attempts` failures
+
+        :param attempts: Number of attempts which failed
+        :return: Time as string in server datetime format
+        """
+        delay = min(
+            self.RETRY_DELAY * 2 ** (attempts - 1), self.MAX_RETRY_DELAY
+        )
+        return (
+            datetime.now() + timedelta(minutes=delay)
+        ).strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+
+    def retry(self, cursor, user, ids=None, context=None):
+        """
+        Retries the import of failed orders. If no ids are given, all the
+        pending failures due for an attempt are retried. This method is
+        called by cron.
+
+        :param cursor: Database cursor
+        :param user: ID of current user
+        :param ids: IDs of failures to retry
+        :param context: Application context
+        :return: List of browse records of sales imported
+        """
+        if not ids:
+            ids = self.search(cursor, user, [
+                ('state', '=', 'pending'),
+                ('next_attempt', '<=', time.strftime(
+                    DEFAULT_SERVER_DATETIME_FORMAT
+                )),
+            ], context=context)
+
+        sales = []
+        cache = RunCache()
+        for failure in self.browse(cursor, user, ids, context=context):
+            if failure.state != 'pending':
+                continue
+
+            store_view = failure.store_view
+            new_context = dict(context or {})
+            new_context.update({
+                'magento_cache': cache,
+                'magento_instance': store_view.instance.id,
+                'magento_website': store_view.website.id,
+                'magento_store_view': store_view.id,
+            })
+            sale = self.import_order(
+                cursor, user, json.loads(failure.payload), new_context
+            )
+            if sale:
+                self.write(cursor, user, failure.id, {
+                    'state': 'done',
+                }, context=context)
+                sales.append(sale)
+
+        return sales
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+    session
+
+    API sessions on a magento instance shared across a job
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: AGPLv3, see LICENSE for more details.
+"""
+from contextlib import contextmanager
+from itertools import imap
+from multiprocessing.pool import ThreadPool
+import threading
+
+
+class Session(object):
+    """
+    A session on a magento instance which lives as long as the job (a cron
+    run or a wizard action) using it.
+
+    Every API class is logged in once, on first use, and the same
+    authenticated client is handed out for all later calls. This keeps the
+    HTTP connection alive and saves a login and an endSession for every
+    record exported.
+    """
+
+    def __init__(self, instance):
+        """
+        :param instance: Browse record of magento.instance
+        """
+        self.instance_id = instance.id
+        self.args = (instance.url, instance.api_user, instance.api_key)
+
+        # Number of logins done on the instance in this session
+        self.logins = 0
+        self.apis = {}
+
+    def get(self, api_class):
+        """
+        Returns a logged in client of `api_class` for the instance
+
+        :param api_class: The magento API class. Example: magento.Inventory
+        :return: Instance of `api_class` with an active session
+        """
+        if api_class not in self.apis:
+            self.apis[api_class] = api_class(*self.args).__enter__()
+            self.logins += 1
+        return self.apis[api_class]
+
+    def imap(self, api_class, method, arguments, workers=1):
+        """
+        Calls `method` of `api_class` once for each of the `arguments` and
+        yields the results in the same order.
+
+        With more than one worker, the calls are made concurrently from a
+        pool of `workers` threads. An XML-RPC client cannot be shared
+        between threads, so each thread logs in with its own client which is
+        ended once all the calls are done. Only the calls to magento are
+        made in the threads, the results are consumed in the calling thread.
+
+        :param api_class: The magento API class. Example: magento.Order
+        :param method: Name of the method to call on the API
+        :param arguments: List of arguments, one for each call
+        :param workers: Maximum number of calls made at the same time
+        """
+        if workers <= 1 or len(arguments) <= 1:
+            for result in imap(
+                getattr(self.get(api_class), method), arguments
+            ):
+                yield result
+            return
+
+        local = threading.local()
+        lock = threading.Lock()
+        clients = []
+
+        def call(argument):
+            if not hasattr(local, 'api'):
+                local.api = api_class(*self.args).__enter__()
+                with lock:
+                    clients.append(local.api)
+                    self.logins += 1
+            return getattr(local.api, method)(argument)
+
+        pool = ThreadPool(min(workers, len(arguments)))
+        try:
+            for result in pool.imap(call, arguments):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+            for api in clients:
+                api.__exit__(None, None, None)
+
+    def close(self):
+        """
+        Ends all the API sessions opened on the instance
+        """
+        apis, self.apis = self.apis, {}
+        for api in apis.values():
+            api.__exit__(None, None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __deepcopy__(self, memo):
+        # The context is deepcopied in many places, but everything in the job
+        # must share the same session
+        return self
+
+
+@contextmanager
+def job_session(instance, context):
+    """
+    Yields the session of the current job for `instance`.
+
+    If the context does not carry a session for the instance yet, a new one
+    is opened and made available through the context to everything called
+    within the block. It is closed when the block exits.
+
+    :param instance: Browse record of magento.instance
+    :param context: Application context
+    """
+    previous = context.get('magento_session') if context is not None \
+        else None
+
+    if previous is not None and previous.instance_id == instance.id:
+        yield previous
+        return
+
+    with Session(instance) as session:
+        if context is None:
+            yield session
+            return
+
+        context['magento_session'] = session
+        try:
+            yield session
+        finally:
+            if previous is None:
+                del context['magento_session']
+            else:
+                context['magento_session'] = previous
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark_inventory
+
+    Compares the computation of stock for inventory export product by
+    product against the computation for the whole website at once.
+
+    This is not a part of the test suite. Run it with:
+
+        python -m unittest tests.benchmark_inventory
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: AGPLv3, see LICENSE for more details.
+"""
+from copy import deepcopy
+import time
+import unittest
+
+from itsbroken.transaction import Transaction
+from itsbroken.testing import DB_NAME, POOL, USER, CONTEXT
+
+from test_base import TestBase
+
+PRODUCT_COUNT = 10000
+
+
+class BenchmarkInventory(TestBase):
+    """
+    Benchmark the stock computation for inventory export
+    """
+
+    def setup_products(self, txn, context):
+        """
+        Create synthetic products linked to the first website
+        """
+        product_obj = POOL.get('product.product')
+
+        for index in xrange(PRODUCT_COUNT):
+            product_obj.create(txn.cursor, txn.user, {
+                'name': 'Benchmark product %d' % index,
+                'default_code': 'BENCH-%d' % index,
+                'type': 'product',
+                'magento_ids': [(0, 0, {
+                    'magento_id': index + 1,
+                    'website': self.website_id1,
+                })],
+            }, context=context)
+
+    def test_quantity_computation(self):
+        """
+        Time the per record and bulk computation of quantity available
+        """
+        website_obj = POOL.get('magento.instance.website')
+        product_obj = POOL.get('product.product')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults(txn)
+            context = deepcopy(CONTEXT)
+            self.setup_products(txn, context)
+
+            website = website_obj.browse(
+                txn.cursor, txn.user, self.website_id1, context
+            )
+            product_ids = [
+                magento_product.product.id
+                for magento_product in website.magento_products
+            ]
+
+            start = time.time()
+            per_record = dict([
+                (product_id, product_obj.browse(
+                    txn.cursor, txn.user, product_id, context
+                ).qty_available) for product_id in product_ids
+            ])
+            per_record_time = time.time() - start
+
+            start = time.time()
+            bulk = website_obj.get_product_quantities(
+                txn.cursor, txn.user, website, context
+            )
+            bulk_time = time.time() - start
+
+            self.assertEqual(per_record, bulk)
+
+            print '\n%d products' % len(product_ids)
+            print 'Per record: %.3fs' % per_record_time
+            print 'Bulk:       %.3fs' % bulk_time
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,6 +9,7 @@
 """
 import unittest
 
+from mock import patch
 from itsbroken.transaction import Transaction
 from itsbroken.testing import DB_NAME, POOL, USER, CONTEXT
 
@@ -127,6 +128,87 @@ class TestCountry(TestBase):
             )
             self.assertEqual(len(states), 1)
 
+    def test_0050_find_state_in_region_index(self):
+        """
+        Tests that states are found by their name in any case from the
+        index of states, and that states not committed are left out of the
+        index but still found by the transaction which created them
+        """
+        state_obj = POOL.get('res.country.state')
+        country_obj = POOL.get('res.country')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            country = country_obj.search_using_magento_code(
+                txn.cursor, txn.user, 'US', txn.context
+            )
+            state_id, = state_obj.search(
+                txn.cursor, txn.user, [
+                    ('name', '=', 'Florida'),
+                    ('country_id', '=', country.id),
+                ], context=txn.context
+            )
+
+            self.assertEqual(
+                state_obj.get_region_index(txn.cursor, txn.user)[
+                    ('US', 'FLORIDA')
+                ], state_id
+            )
+            self.assertEqual(
+                state_obj.find_using_magento_region(
+                    txn.cursor, txn.user, country, 'florida', txn.context
+                ).id, state_id
+            )
+
+            state = state_obj.find_or_create_using_magento_region(
+                txn.cursor, txn.user, country, 'Magento Region', txn.context
+            )
+            self.assertFalse(
+                ('US', 'MAGENTO REGION') in state_obj.get_region_index(
+                    txn.cursor, txn.user
+                )
+            )
+            self.assertEqual(
+                state_obj.find_using_magento_region(
+                    txn.cursor, txn.user, country, 'Magento Region',
+                    txn.context
+                ).id, state.id
+            )
+
+    def test_0060_find_state_with_stale_region_index(self):
+        """
+        Tests that a state in the index of states which no longer has the
+        region is left out, and the state is found by a search
+        """
+        state_obj = POOL.get('res.country.state')
+        country_obj = POOL.get('res.country')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            country = country_obj.search_using_magento_code(
+                txn.cursor, txn.user, 'US', txn.context
+            )
+            state_id, = state_obj.search(
+                txn.cursor, txn.user, [
+                    ('name', '=', 'Florida'),
+                    ('country_id', '=', country.id),
+                ], context=txn.context
+            )
+            other_id, = state_obj.search(
+                txn.cursor, txn.user, [
+                    ('name', '=', 'Texas'),
+                    ('country_id', '=', country.id),
+                ], context=txn.context
+            )
+
+            with patch.object(
+                state_obj, 'get_region_index',
+                return_value={('US', 'FLORIDA'): other_id}
+            ):
+                self.assertEqual(
+                    state_obj.find_using_magento_region(
+                        txn.cursor, txn.user, country, 'Florida', txn.context
+                    ).id, state_id
+                )
+
 
 def suite():
     """
@@ -7,12 +7,15 @@
     :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+from copy import deepcopy
 import unittest
 
+from mock import patch
 from itsbroken.transaction import Transaction
 from itsbroken.testing import DB_NAME, POOL, USER, CONTEXT
 
 from test_base import TestBase
+from openerp.addons.magento_integration.cache import RunCache
 
 
 class TestCurrency(TestBase):
@@ -58,6 +61,70 @@ class TestCurrency(TestBase):
                     txn.cursor, txn.user, code, txn.context
                 )
 
+    def test_0030_search_currency_from_code_index(self):
+        """
+        Tests that currencies are found in the index of codes, which counts
+        its hits, and that the changes to currencies are seen by the
+        transaction which made them
+        """
+        currency_obj = POOL.get('res.currency')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            context = deepcopy(txn.context)
+            context['magento_cache'] = RunCache()
+
+            for index in range(3):
+                currency = currency_obj.search_using_magento_code(
+                    txn.cursor, txn.user, 'USD', context
+                )
+            self.assertEqual(
+                context['magento_cache'].counters['index_hits'], 3
+            )
+
+            currency_obj.write(txn.cursor, txn.user, [currency.id], {
+                'name': 'XUS',
+            }, context=context)
+            self.assertEqual(
+                currency_obj.search_using_magento_code(
+                    txn.cursor, txn.user, 'XUS', context
+                ).id, currency.id
+            )
+            with self.assertRaises(Exception):
+                currency_obj.search_using_magento_code(
+                    txn.cursor, txn.user, 'USD', context
+                )
+
+    def test_0040_search_currency_with_stale_code_index(self):
+        """
+        Tests that a currency in the index of codes which no longer has the
+        code is left out, and the currency is found by a search
+        """
+        currency_obj = POOL.get('res.currency')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            context = deepcopy(txn.context)
+            context['magento_cache'] = RunCache()
+
+            currency_id, = currency_obj.search(
+                txn.cursor, txn.user, [('name', '=', 'USD')], context=context
+            )
+            other_id, = currency_obj.search(
+                txn.cursor, txn.user, [('name', '=', 'EUR')], context=context
+            )
+
+            with patch.object(
+                currency_obj, 'get_code_index',
+                return_value={'USD': other_id}
+            ):
+                self.assertEqual(
+                    currency_obj.search_using_magento_code(
+                        txn.cursor, txn.user, 'USD', context
+                    ).id, currency_id
+                )
+            self.assertFalse(
+                context['magento_cache'].counters.get('index_hits')
+            )
+
 
 def suite():
     """
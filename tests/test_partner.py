@@ -11,6 +11,8 @@ from copy import deepcopy
 import unittest
 
 import magento
+import psycopg2
+from mock import patch
 from itsbroken.transaction import Transaction
 from itsbroken.testing import DB_NAME, POOL, USER, CONTEXT
 
@@ -395,6 +397,235 @@ class TestPartner(TestBase):
                 )
             )
 
+    @unittest.skipIf(not settings.MOCK, "requries mock settings")
+    def test0050_find_address_by_fingerprint(self):
+        """
+        Tests that an address is found by its fingerprint among the
+        addresses of the customer, regardless of case and spaces
+        """
+        partner_obj = POOL.get('res.partner')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+
+            self.setup_defaults(txn)
+
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_website': self.website_id1,
+                'magento_store_view': self.store_view_id,
+            })
+
+            partner = partner_obj.find_or_create(
+                txn.cursor, txn.user, load_json('customers', '1'), context
+            )
+            address_data = load_json('addresses', '1')
+            address = partner_obj.\
+                find_or_create_address_as_partner_using_magento_data(
+                    txn.cursor, txn.user, address_data, partner, context
+                )
+            self.assertTrue(address.magento_address_fingerprint)
+
+            address_data['city'] = ' %s ' % address_data['city'].upper()
+            self.assertEqual(
+                partner_obj.
+                find_or_create_address_as_partner_using_magento_data(
+                    txn.cursor, txn.user, address_data, partner, context
+                ).id, address.id
+            )
+
+            # The fingerprint follows the name of the state of the address
+            address_data['region'] = 'Renamed Region'
+            POOL.get('res.country.state').write(
+                txn.cursor, txn.user, address.state_id.id, {
+                    'name': address_data['region'],
+                }, context=context
+            )
+            self.assertEqual(
+                partner_obj.browse(
+                    txn.cursor, txn.user, address.id, context=context
+                ).magento_address_fingerprint,
+                partner_obj.get_magento_data_fingerprint(address_data)
+            )
+
+            # The fingerprint follows the changes of the address
+            partner_obj.write(txn.cursor, txn.user, address.id, {
+                'street': 'changed street',
+            }, context=context)
+            partners_before = partner_obj.search(
+                txn.cursor, txn.user, [], context=context, count=True
+            )
+            partner_obj.find_or_create_address_as_partner_using_magento_data(
+                txn.cursor, txn.user, address_data, partner, context
+            )
+            self.assertEqual(
+                partner_obj.search(
+                    txn.cursor, txn.user, [], context=context, count=True
+                ), partners_before + 1
+            )
+
+    def test0060_create_existing_customer_falls_back_to_find(self):
+        """
+        Tests that creating a customer which already exists in the website
+        returns the existing partner, while guest customers can repeat
+        """
+        partner_obj = POOL.get('res.partner')
+        magento_partner_obj = POOL.get('magento.website.partner')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+
+            self.setup_defaults(txn)
+
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_website': self.website_id1,
+                'magento_store_view': self.store_view_id,
+            })
+            customer_data = load_json('customers', '1')
+
+            partner = partner_obj.create_using_magento_data(
+                txn.cursor, txn.user, customer_data, context
+            )
+            partners_before = magento_partner_obj.search(
+                txn.cursor, txn.user, [], context=context, count=True
+            )
+            self.assertEqual(
+                partner_obj.create_using_magento_data(
+                    txn.cursor, txn.user, customer_data, context
+                ).id, partner.id
+            )
+            self.assertEqual(
+                magento_partner_obj.search(
+                    txn.cursor, txn.user, [], context=context, count=True
+                ), partners_before
+            )
+
+            guest_data = {
+                'firstname': customer_data['firstname'],
+                'lastname': customer_data['lastname'],
+                'email': customer_data['email'],
+            }
+            guest = partner_obj.create_using_magento_data(
+                txn.cursor, txn.user, guest_data, context
+            )
+            self.assertNotEqual(
+                partner_obj.create_using_magento_data(
+                    txn.cursor, txn.user, guest_data, context
+                ).id, guest.id
+            )
+
+    def test0065_create_conflict_not_visible_is_raised(self):
+        """
+        Tests that a customer rejected by the unique index is raised again
+        when the existing partner is not visible, as when a concurrent
+        import committed it, and that the transaction remains usable
+        """
+        partner_obj = POOL.get('res.partner')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+
+            self.setup_defaults(txn)
+
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_website': self.website_id1,
+                'magento_store_view': self.store_view_id,
+            })
+            customer_data = load_json('customers', '2')
+
+            with patch.object(
+                partner_obj, 'create',
+                side_effect=psycopg2.IntegrityError('duplicate key')
+            ):
+                with self.assertRaises(psycopg2.IntegrityError):
+                    partner_obj.create_using_magento_data(
+                        txn.cursor, txn.user, customer_data, context
+                    )
+
+            self.assertFalse(
+                partner_obj.find_using_magento_data(
+                    txn.cursor, txn.user, customer_data, context
+                )
+            )
+            self.assertTrue(
+                partner_obj.create_using_magento_data(
+                    txn.cursor, txn.user, customer_data, context
+                )
+            )
+
+    def test0070_merge_guest_customers_by_email(self):
+        """
+        Tests that the guests with the same email are imported under one
+        partner only when the website merges guest customers
+        """
+        partner_obj = POOL.get('res.partner')
+        website_obj = POOL.get('magento.instance.website')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+
+            self.setup_defaults(txn)
+
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_website': self.website_id1,
+                'magento_store_view': self.store_view_id,
+            })
+            guest_data = {
+                'firstname': 'Guest',
+                'lastname': 'Customer',
+                'email': 'guest@example.com',
+            }
+
+            guest = partner_obj.find_or_create_guest_using_magento_data(
+                txn.cursor, txn.user, guest_data, context
+            )
+            self.assertNotEqual(
+                partner_obj.find_or_create_guest_using_magento_data(
+                    txn.cursor, txn.user, guest_data, context
+                ).id, guest.id
+            )
+
+            website_obj.write(txn.cursor, txn.user, [
+                self.website_id1, self.website_id2
+            ], {
+                'merge_guest_customers': True,
+            }, context=context)
+            guest_data['email'] = ' Guest@Example.com '
+            self.assertTrue(
+                partner_obj.find_or_create_guest_using_magento_data(
+                    txn.cursor, txn.user, guest_data, context
+                ).id in [
+                    partner.id for partner in partner_obj.browse(
+                        txn.cursor, txn.user, partner_obj.search(
+                            txn.cursor, txn.user, [
+                                ('email', '=', 'guest@example.com')
+                            ], context=context
+                        ), context=context
+                    )
+                ]
+            )
+            partners_before = partner_obj.search(
+                txn.cursor, txn.user, [], context=context, count=True
+            )
+            partner_obj.find_or_create_guest_using_magento_data(
+                txn.cursor, txn.user, guest_data, context
+            )
+            self.assertEqual(
+                partner_obj.search(
+                    txn.cursor, txn.user, [], context=context, count=True
+                ), partners_before
+            )
+
+            # Guests are not merged across websites
+            context['magento_website'] = self.website_id2
+            partner_obj.find_or_create_guest_using_magento_data(
+                txn.cursor, txn.user, guest_data, context
+            )
+            self.assertEqual(
+                partner_obj.search(
+                    txn.cursor, txn.user, [], context=context, count=True
+                ), partners_before + 1
+            )
+
 
 def suite():
     _suite = unittest.TestSuite()
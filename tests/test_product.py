@@ -6,7 +6,9 @@
     :license: AGPL, see LICENSE for more details.
 """
 from copy import deepcopy
+import sys
 import unittest
+import xmlrpclib
 import magento
 
 from mock import patch, MagicMock
@@ -14,6 +16,8 @@ from itsbroken.transaction import Transaction
 from itsbroken.testing import DB_NAME, POOL, USER, CONTEXT
 
 from test_base import TestBase, load_json
+from openerp.addons.magento_integration.cache import RunCache
+from openerp.addons.magento_integration.session import Session
 import settings
 
 
@@ -37,6 +41,21 @@ def mock_product_api(mock=None, data=None):
 
     handle = MagicMock(spec=magento.Product)
     handle.info.side_effect = lambda id: load_json('products', str(id))
+
+    def multi_call(calls):
+        results = []
+        for path, arguments in calls:
+            try:
+                results.append(handle.info(*arguments))
+            except xmlrpclib.Fault, fault:
+                results.append({
+                    'isFault': True,
+                    'faultCode': fault.faultCode,
+                    'faultMessage': fault.faultString,
+                })
+        return results
+    handle.multiCall.side_effect = multi_call
+
     if data is None:
         handle.__enter__.return_value = handle
     else:
@@ -122,6 +141,66 @@ class TestProduct(TestBase):
                 ], count=True) == 0
             )
 
+    def test_0015_import_deep_category_tree(self):
+        """Test the import of a category tree deeper than the recursion
+        limit, and that importing it again creates no categories
+        """
+        category_obj = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults(txn)
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_instance': self.instance_id1,
+                'magento_website': self.website_id1
+            })
+
+            depth = sys.getrecursionlimit() + 100
+            category_tree = node = {
+                'category_id': '1', 'name': 'Root', 'children': []
+            }
+            for magento_id in xrange(2, depth + 1):
+                child = {
+                    'category_id': str(magento_id),
+                    'name': 'Category %d' % magento_id,
+                    'children': [],
+                }
+                node['children'].append(child)
+                node = child
+
+            categories_before_import = category_obj.search(
+                txn.cursor, txn.user, [], count=True
+            )
+            category_obj.create_tree_using_magento_data(
+                txn.cursor, txn.user, category_tree, context
+            )
+            categories_after_import = category_obj.search(
+                txn.cursor, txn.user, [], count=True
+            )
+            self.assertEqual(
+                categories_after_import - categories_before_import, depth
+            )
+
+            deepest = category_obj.find_using_magento_id(
+                txn.cursor, txn.user, depth, context
+            )
+            root = category_obj.find_using_magento_id(
+                txn.cursor, txn.user, 1, context
+            )
+            self.assertTrue(
+                deepest.id in category_obj.search(txn.cursor, txn.user, [
+                    ('id', 'child_of', root.id)
+                ])
+            )
+
+            category_obj.create_tree_using_magento_data(
+                txn.cursor, txn.user, category_tree, context
+            )
+            self.assertEqual(
+                category_obj.search(txn.cursor, txn.user, [], count=True),
+                categories_after_import
+            )
+
     def test_0020_import_simple_product(self):
         """Test the import of simple product using magento data
         """
@@ -259,6 +338,50 @@ class TestProduct(TestBase):
                 product.categ_id.name, 'Unclassified Magento Products'
             )
 
+    @unittest.skipIf(not settings.MOCK, "requries mock settings")
+    def test_0035_import_products_with_unknown_categories(self):
+        """Test that the category tree is fetched once for the run when the
+        categories of products being imported are not known
+        """
+        product_obj = POOL.get('product.product')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults(txn)
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_instance': self.instance_id1,
+                'magento_website': self.website_id1,
+                'magento_cache': RunCache(),
+            })
+
+            category_api = MagicMock(spec=magento.Category)
+            handle = category_api.return_value
+            handle.__enter__.return_value = handle
+            handle.tree.side_effect = \
+                lambda root: load_json('categories', 'category_tree')
+
+            with patch('magento.Category', category_api, create=True):
+                for magento_id in ['158', '162', '166', '27']:
+                    product = product_obj.create_using_magento_data(
+                        txn.cursor, txn.user,
+                        load_json('products', magento_id), context
+                    )
+                    if magento_id == '27':
+                        self.assertEqual(
+                            product.categ_id.name,
+                            'Unclassified Magento Products'
+                        )
+                    else:
+                        self.assertEqual(
+                            product.categ_id.magento_ids[0].magento_id,
+                            int(load_json(
+                                'products', magento_id
+                            )['categories'][0])
+                        )
+
+            self.assertEqual(handle.tree.call_count, 1)
+            self.assertFalse(handle.info.called)
+
     def test_0040_import_configurable_product(self):
         """Test the import of a configurable product using magento data
         """
@@ -539,6 +662,228 @@ class TestProduct(TestBase):
                     txn.cursor, txn.user, website, context
                 )
 
+    @unittest.skipIf(not settings.MOCK, "requries mock settings")
+    def test_0085_export_stock_information_uses_one_session(self):
+        """
+        Check that the stock export for a website logs in on magento only
+        once irrespective of the number of products exported
+        """
+        product_obj = POOL.get('product.product')
+        website_obj = POOL.get('magento.instance.website')
+        category_obj = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults(txn)
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_instance': self.instance_id1,
+                'magento_website': self.website_id1,
+            })
+
+            category_obj.create_using_magento_data(
+                txn.cursor, txn.user, load_json('categories', '17'),
+                context=context
+            )
+            for magento_id in ('135', '144'):
+                product_obj.find_or_create_using_magento_data(
+                    txn.cursor, txn.user, load_json('products', magento_id),
+                    context
+                )
+
+            website = website_obj.browse(
+                txn.cursor, txn.user, self.website_id1, context
+            )
+
+            inventory_api = mock_inventory_api()
+            session = Session(website.instance)
+            context['magento_session'] = session
+            with patch('magento.Inventory', inventory_api, create=True):
+                products = website_obj.export_inventory_to_magento(
+                    txn.cursor, txn.user, website, context
+                )
+                session.close()
+
+            self.assertEqual(len(products), 2)
+            self.assertEqual(session.logins, 1)
+            self.assertEqual(inventory_api.call_count, 1)
+            self.assertEqual(inventory_api.return_value.update.call_count, 2)
+
+    @unittest.skipIf(not settings.MOCK, "requries mock settings")
+    def test_0087_export_stock_information_in_batches(self):
+        """
+        Check that the stock updates are sent in a multiCall when a batch
+        size is set on website and a fault for one product does not stop
+        the export of others
+        """
+        product_obj = POOL.get('product.product')
+        website_obj = POOL.get('magento.instance.website')
+        category_obj = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults(txn)
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_instance': self.instance_id1,
+                'magento_website': self.website_id1,
+            })
+
+            category_obj.create_using_magento_data(
+                txn.cursor, txn.user, load_json('categories', '17'),
+                context=context
+            )
+            for magento_id in ('135', '144'):
+                product_obj.find_or_create_using_magento_data(
+                    txn.cursor, txn.user, load_json('products', magento_id),
+                    context
+                )
+
+            website_obj.write(txn.cursor, txn.user, self.website_id1, {
+                'inventory_batch_size': 10,
+            }, context=context)
+            website = website_obj.browse(
+                txn.cursor, txn.user, self.website_id1, context
+            )
+
+            inventory_api = mock_inventory_api()
+            inventory_api.return_value.multiCall.side_effect = \
+                lambda calls: [True] + [{
+                    'isFault': True,
+                    'faultCode': 101,
+                    'faultMessage': 'Product not exists.',
+                }] * (len(calls) - 1)
+
+            with patch('magento.Inventory', inventory_api, create=True):
+                products = website_obj.export_inventory_to_magento(
+                    txn.cursor, txn.user, website, context
+                )
+
+            self.assertEqual(
+                inventory_api.return_value.multiCall.call_count, 1
+            )
+            self.assertFalse(inventory_api.return_value.update.called)
+            self.assertEqual(len(products), 1)
+
+    @unittest.skipIf(not settings.MOCK, "requries mock settings")
+    def test_0088_export_only_changed_stock_information(self):
+        """
+        Check that the stock of a product is exported again only if it
+        changed since the last export, unless a full export is forced
+        """
+        product_obj = POOL.get('product.product')
+        website_obj = POOL.get('magento.instance.website')
+        category_obj = POOL.get('product.category')
+        magento_product_obj = POOL.get('magento.website.product')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults(txn)
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_instance': self.instance_id1,
+                'magento_website': self.website_id1,
+            })
+
+            category_obj.create_using_magento_data(
+                txn.cursor, txn.user, load_json('categories', '17'),
+                context=context
+            )
+            product_obj.find_or_create_using_magento_data(
+                txn.cursor, txn.user, load_json('products', '135'), context
+            )
+
+            website = website_obj.browse(
+                txn.cursor, txn.user, self.website_id1, context
+            )
+            with patch(
+                'magento.Inventory', mock_inventory_api(), create=True
+            ):
+                products = website_obj.export_inventory_to_magento(
+                    txn.cursor, txn.user, website, context
+                )
+            self.assertEqual(len(products), 1)
+
+            magento_product, = magento_product_obj.browse(
+                txn.cursor, txn.user, magento_product_obj.search(
+                    txn.cursor, txn.user, [
+                        ('website', '=', self.website_id1)
+                    ], context=context
+                ), context=context
+            )
+            self.assertEqual(magento_product.exported_is_in_stock, '0')
+            self.assertEqual(magento_product.exported_qty, 0)
+
+            # Nothing changed, so nothing is exported
+            website = website_obj.browse(
+                txn.cursor, txn.user, self.website_id1, context
+            )
+            with patch(
+                'magento.Inventory', mock_inventory_api(), create=True
+            ):
+                products = website_obj.export_inventory_to_magento(
+                    txn.cursor, txn.user, website, context
+                )
+            self.assertEqual(len(products), 0)
+
+            context['force_full_inventory_export'] = True
+            with patch(
+                'magento.Inventory', mock_inventory_api(), create=True
+            ):
+                products = website_obj.export_inventory_to_magento(
+                    txn.cursor, txn.user, website, context
+                )
+            self.assertEqual(len(products), 1)
+
+    @unittest.skipIf(not settings.MOCK, "requries mock settings")
+    def test_0089_import_catalog_fetches_only_new_products(self):
+        """
+        Tests that the catalog import fetches the details of only the new
+        products listed, together in one multiCall request
+        """
+        category_obj = POOL.get('product.category')
+        product_obj = POOL.get('product.product')
+        website_obj = POOL.get('magento.instance.website')
+        import_catalog_obj = POOL.get('magento.instance.import_catalog')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults(txn)
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_instance': self.instance_id1,
+                'magento_website': self.website_id1,
+            })
+            category_obj.create_tree_using_magento_data(
+                txn.cursor, txn.user, load_json('categories', 'category_tree'),
+                context
+            )
+            with patch('magento.Product', mock_product_api(), create=True):
+                known_product = product_obj.find_or_create_using_magento_id(
+                    txn.cursor, txn.user, 27, context
+                )
+
+            product_api = mock_product_api()
+            product_api.return_value.list.side_effect = \
+                lambda store_view: [
+                    {'product_id': '27'},
+                    {'product_id': '144'},
+                    {'product_id': '158'},
+                ]
+            website = website_obj.browse(
+                txn.cursor, txn.user, self.website_id1, context
+            )
+            with patch('magento.Product', product_api, create=True):
+                product_ids = import_catalog_obj.import_products(
+                    txn.cursor, txn.user, website, context
+                )
+
+            self.assertEqual(len(product_ids), 3)
+            self.assertEqual(product_ids[0], known_product.id)
+            self.assertEqual(
+                product_api.return_value.multiCall.call_count, 1
+            )
+            calls, = product_api.return_value.multiCall.call_args[0]
+            self.assertEqual(
+                [arguments[0] for path, arguments in calls], [144, 158]
+            )
+
     def test_0090_tier_prices(self):
         """Checks the function field on product price tiers
         """
@@ -617,6 +962,106 @@ class TestProduct(TestBase):
 
             self.assertEqual(product.lst_price - 5, tier.price)
 
+    @unittest.skipIf(not settings.MOCK, "requries mock settings")
+    def test_0095_export_tier_prices_in_batches(self):
+        """Checks that the tier prices of all products of the store are
+        computed together and exported in one multiCall request
+        """
+        product_obj = POOL.get('product.product')
+        store_obj = POOL.get('magento.website.store')
+        category_obj = POOL.get('product.category')
+        pricelist_item_obj = POOL.get('product.pricelist.item')
+        store_price_tier_obj = POOL.get('magento.store.price_tier')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults(txn)
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_instance': self.instance_id1,
+                'magento_website': self.website_id1,
+                'magento_store': self.store_id,
+            })
+            store = store_obj.browse(
+                txn.cursor, txn.user, self.store_id, context=context
+            )
+            category_obj.create_using_magento_data(
+                txn.cursor, txn.user, load_json('categories', '17'),
+                context=context
+            )
+            products = [
+                product_obj.find_or_create_using_magento_data(
+                    txn.cursor, txn.user, load_json('products', magento_id),
+                    context
+                ) for magento_id in ['135', '135001']
+            ]
+            pricelist_item_obj.create(txn.cursor, txn.user, {
+                'name': 'Test line',
+                'price_version_id': store.shop.pricelist_id.version_id[0].id,
+                'min_quantity': 10,
+                'base': 1,
+                'price_surcharge': -5,
+            }, context=context)
+            for quantity in [1, 10]:
+                store_price_tier_obj.create(txn.cursor, txn.user, {
+                    'store': self.store_id,
+                    'quantity': quantity,
+                }, context=context)
+
+            tier_price_api = MagicMock(spec=magento.ProductTierPrice)
+            handle = tier_price_api.return_value
+            handle.__enter__.return_value = handle
+            handle.multiCall.side_effect = lambda calls: [True] * len(calls)
+
+            store = store_obj.browse(
+                txn.cursor, txn.user, self.store_id, context=context
+            )
+            with patch(
+                'magento.ProductTierPrice', tier_price_api, create=True
+            ):
+                exported = store_obj.export_tier_prices_to_magento(
+                    txn.cursor, txn.user, store, context
+                )
+
+            self.assertEqual(len(exported), 2)
+            self.assertEqual(handle.multiCall.call_count, 1)
+            calls, = handle.multiCall.call_args[0]
+            price_data = dict(
+                (magento_id, data) for path, (magento_id, data) in calls
+            )
+            for product in products:
+                self.assertEqual(
+                    price_data[product.magento_ids[0].magento_id], [
+                        {'qty': 1, 'price': product.lst_price},
+                        {'qty': 10, 'price': product.lst_price - 5},
+                    ]
+                )
+
+            # Nothing changed, nothing is exported
+            with patch(
+                'magento.ProductTierPrice', tier_price_api, create=True
+            ):
+                exported = store_obj.export_tier_prices_to_magento(
+                    txn.cursor, txn.user, store, context
+                )
+            self.assertEqual(exported, [])
+            self.assertEqual(handle.multiCall.call_count, 1)
+
+            # A change of the pricelist exports all the tier prices again
+            pricelist_item_obj.create(txn.cursor, txn.user, {
+                'name': 'Another line',
+                'price_version_id': store.shop.pricelist_id.version_id[0].id,
+                'min_quantity': 100,
+                'base': 1,
+                'price_surcharge': -10,
+            }, context=context)
+            with patch(
+                'magento.ProductTierPrice', tier_price_api, create=True
+            ):
+                exported = store_obj.export_tier_prices_to_magento(
+                    txn.cursor, txn.user, store, context
+                )
+            self.assertEqual(len(exported), 2)
+
     def test_0100_update_product_using_magento_data(self):
         """Check if the product gets updated
         """
@@ -786,6 +1231,137 @@ class TestProduct(TestBase):
                 product_after_updation['description']
             )
 
+    def test_0104_update_product_skips_unchanged_values(self):
+        """
+        Tests that a product is not written when the data from magento has
+        not changed, and that only the changed values are written
+        """
+        product_obj = POOL.get('product.product')
+        category_obj = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults(txn)
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_instance': self.instance_id1,
+                'magento_website': self.website_id1,
+                'magento_cache': RunCache(),
+            })
+            category_obj.create_using_magento_data(
+                txn.cursor, txn.user, load_json('categories', '17'),
+                context=context
+            )
+            product_data = load_json('products', '135001')
+            product = product_obj.find_or_create_using_magento_data(
+                txn.cursor, txn.user, product_data, context
+            )
+
+            with patch.object(
+                product_obj, 'write', wraps=product_obj.write
+            ) as write:
+                product = product_obj.update_from_magento_using_data(
+                    txn.cursor, txn.user, product, product_data, context
+                )
+                self.assertFalse(write.called)
+
+                # Prices differing beyond their precision are the same
+                product_data['special_price'] = '%.6f' % (
+                    product.list_price + 0.000001
+                )
+                product = product_obj.update_from_magento_using_data(
+                    txn.cursor, txn.user, product, product_data, context
+                )
+                self.assertFalse(write.called)
+
+                product_data['name'] = 'Updated-product'
+                product = product_obj.update_from_magento_using_data(
+                    txn.cursor, txn.user, product, product_data, context
+                )
+                self.assertEqual(
+                    write.call_args[0][3], {'name': 'Updated-product'}
+                )
+
+            self.assertEqual(product.name, 'Updated-product')
+            self.assertEqual(
+                context['magento_cache'].counters,
+                {'products_skipped': 2, 'products_written': 1}
+            )
+
+    @unittest.skipIf(not settings.MOCK, "requries mock settings")
+    def test_0105_update_catalog_of_changed_products(self):
+        """
+        Tests that the catalog update fetches only the imported products
+        listed as changed since the last update, and resumes an interrupted
+        update after the last product updated
+        """
+        category_obj = POOL.get('product.category')
+        product_obj = POOL.get('product.product')
+        website_obj = POOL.get('magento.instance.website')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults(txn)
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_instance': self.instance_id1,
+                'magento_website': self.website_id1,
+            })
+            category_obj.create_tree_using_magento_data(
+                txn.cursor, txn.user, load_json('categories', 'category_tree'),
+                context
+            )
+            with patch('magento.Product', mock_product_api(), create=True):
+                product_obj.find_or_create_all_using_magento_ids(
+                    txn.cursor, txn.user, [27, 144, 158], context
+                )
+
+            filters_used = []
+
+            def list_products(filters, store_view):
+                filters_used.append(filters)
+                return [
+                    {'product_id': '158'},
+                    {'product_id': '27'},
+                    {'product_id': '135'},
+                    {'product_id': '144'},
+                ]
+
+            # An earlier update was interrupted after product 27
+            website_obj.write(txn.cursor, txn.user, self.website_id1, {
+                'last_catalog_update_time': '2014-01-01 00:00:00',
+                'catalog_update_started': '2014-01-02 00:00:00',
+                'catalog_update_resume_id': 27,
+            }, context=context)
+
+            product_api = mock_product_api()
+            product_api.return_value.list.side_effect = list_products
+            website = website_obj.browse(
+                txn.cursor, txn.user, self.website_id1, context
+            )
+            with patch('magento.Product', product_api, create=True):
+                products = website_obj.update_catalog_from_magento(
+                    txn.cursor, txn.user, website, context
+                )
+
+            self.assertEqual(len(products), 2)
+            self.assertEqual(
+                filters_used[0],
+                {'updated_at': {'gteq': '2014-01-01 00:00:00'}}
+            )
+            # Product 135 is not imported and is not fetched
+            calls, = product_api.return_value.multiCall.call_args[0]
+            self.assertEqual(
+                [arguments[0] for path, arguments in calls], [144, 158]
+            )
+
+            website = website_obj.browse(
+                txn.cursor, txn.user, self.website_id1, context
+            )
+            self.assertEqual(
+                website.last_catalog_update_time, '2014-01-02 00:00:00'
+            )
+            self.assertFalse(website.catalog_update_started)
+            self.assertEqual(website.catalog_update_resume_id, 0)
+
     def test_0110_export_catalog(self):
         """
         Check the export of product catalog to magento.
@@ -11,6 +11,7 @@ from copy import deepcopy
 from contextlib import nested
 import unittest
 import datetime
+import xmlrpclib
 from dateutil.relativedelta import relativedelta
 
 import magento
@@ -21,6 +22,7 @@ from itsbroken.testing import DB_NAME, POOL, USER, CONTEXT
 
 from test_base import TestBase, load_json
 from api import OrderConfig
+from openerp.addons.magento_integration.cache import RunCache
 import settings
 
 
@@ -30,6 +32,21 @@ def mock_product_api(mock=None, data=None):
 
     handle = MagicMock(spec=magento.Product)
     handle.info.side_effect = lambda id: load_json('products', str(id))
+
+    def multi_call(calls):
+        results = []
+        for path, arguments in calls:
+            try:
+                results.append(handle.info(*arguments))
+            except xmlrpclib.Fault, fault:
+                results.append({
+                    'isFault': True,
+                    'faultCode': fault.faultCode,
+                    'faultMessage': fault.faultString,
+                })
+        return results
+    handle.multiCall.side_effect = multi_call
+
     if data is None:
         handle.__enter__.return_value = handle
     else:
@@ -58,6 +75,10 @@ def mock_customer_api(mock=None, data=None):
 
     handle = MagicMock(spec=magento.Customer)
     handle.info.side_effect = lambda id: load_json('customers', str(id))
+    handle.list.side_effect = lambda filters: [
+        load_json('customers', str(id))
+        for id in filters['customer_id']['in']
+    ]
     if data is None:
         handle.__enter__.return_value = handle
     else:
@@ -73,6 +94,10 @@ def mock_shipment_api(mock=None, data=None):
     handle = MagicMock(spec=magento.Shipment)
     handle.create.side_effect = lambda *args, **kwargs: 'Shipment created'
     handle.addtrack.side_effect = lambda *args, **kwargs: True
+    handle.multiCall.side_effect = lambda calls: [{
+        'sales_order_shipment.create': handle.create,
+        'sales_order_shipment.addTrack': handle.addtrack,
+    }[path](*arguments) for path, arguments in calls]
     if data is None:
         handle.__enter__.return_value = handle
     else:
@@ -1240,12 +1265,28 @@ class TestSale(TestBase):
                 txn.cursor, txn.user, map(int, order.picking_ids)
             )
 
-            with patch('magento.Shipment', mock_shipment_api(), create=True):
+            shipment_api = mock_shipment_api()
+            with patch('magento.Shipment', shipment_api, create=True):
                 # Export shipment status
                 shipments = store_view_obj.export_shipment_status_to_magento(
                     txn.cursor, txn.user, store_view, context=context
                 )
 
+                # Shipments are created together in one multiCall request
+                self.assertEqual(
+                    shipment_api.return_value.multiCall.call_count, 1
+                )
+                calls, = shipment_api.return_value.multiCall.call_args[0]
+                self.assertEqual(calls, [
+                    ['sales_order_shipment.create', [
+                        order.name[len(store_view.instance.order_prefix):],
+                        {}, '', True, False
+                    ]]
+                ])
+                self.assertEqual(
+                    shipments[0].magento_increment_id, 'Shipment created'
+                )
+
                 # Export Tracking info
                 self.assertEqual(
                     store_view_obj.export_tracking_info_to_magento(
@@ -1577,6 +1618,609 @@ class TestSale(TestBase):
                     txn.cursor, txn.user, store_view, context=context
                 )
 
+    def setup_order_import(self, txn, context):
+        """
+        Setup the order states and categories needed to import orders from
+        the mocked magento data
+        """
+        magento_order_state_obj = POOL.get('magento.order_state')
+        category_obj = POOL.get('product.category')
+
+        magento_order_state_obj.create_all_using_magento_data(
+            txn.cursor, txn.user, load_json('order-states', 'all'),
+            context=context
+        )
+        category_obj.create_tree_using_magento_data(
+            txn.cursor, txn.user, load_json('categories', 'category_tree'),
+            context
+        )
+
+    @unittest.skipIf(not settings.MOCK, "requries mock settings")
+    def test_0090_import_orders_with_concurrent_fetch(self):
+        """
+        Tests import of orders from store view when the order details are
+        fetched by more than one worker
+        """
+        instance_obj = POOL.get('magento.instance')
+        store_view_obj = POOL.get('magento.store.store_view')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults(txn)
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_instance': self.instance_id1,
+                'magento_store_view': self.store_view_id,
+                'magento_website': self.website_id1,
+            })
+            self.setup_order_import(txn, context)
+
+            instance_obj.write(txn.cursor, txn.user, self.instance_id1, {
+                'order_fetch_workers': 2,
+            }, context=context)
+            store_view = store_view_obj.browse(
+                txn.cursor, txn.user, self.store_view_id, context
+            )
+
+            increment_ids = ['100000001', '100000005']
+            order_api = mock_order_api()
+            order_api.return_value.list.side_effect = lambda filters: [
+                {'increment_id': increment_id}
+                for increment_id in increment_ids
+            ]
+
+            with nested(
+                patch('magento.Order', order_api, create=True),
+                patch('magento.Product', mock_product_api(), create=True),
+                patch('magento.Customer', mock_customer_api(), create=True),
+            ):
+                sales = store_view_obj.import_orders_from_store_view(
+                    txn.cursor, txn.user, store_view, context
+                )
+
+            # Sales are created in the order they were listed
+            self.assertEqual(
+                [sale.name for sale in sales],
+                [
+                    store_view.instance.order_prefix + increment_id
+                    for increment_id in increment_ids
+                ]
+            )
+            self.assertEqual(order_api.return_value.info.call_count, 2)
+
+    @unittest.skipIf(not settings.MOCK, "requries mock settings")
+    def test_0100_import_orders_in_windows(self):
+        """
+        Tests that orders are listed in windows of update time when a window
+        is configured on instance and that the last import time moves ahead
+        with every window
+        """
+        instance_obj = POOL.get('magento.instance')
+        store_view_obj = POOL.get('magento.store.store_view')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults(txn)
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_instance': self.instance_id1,
+                'magento_store_view': self.store_view_id,
+                'magento_website': self.website_id1,
+            })
+            self.setup_order_import(txn, context)
+
+            instance_obj.write(txn.cursor, txn.user, self.instance_id1, {
+                'order_import_window': 24,
+            }, context=context)
+            last_import_time = datetime.datetime.now() - relativedelta(
+                days=2, hours=12
+            )
+            store_view_obj.write(txn.cursor, txn.user, self.store_view_id, {
+                'last_order_import_time': last_import_time.strftime(
+                    DEFAULT_SERVER_DATETIME_FORMAT
+                ),
+            }, context=context)
+            store_view = store_view_obj.browse(
+                txn.cursor, txn.user, self.store_view_id, context
+            )
+
+            windows = []
+
+            def list_orders(filters):
+                windows.append(filters['updated_at'])
+                if len(windows) == 1:
+                    return [{'increment_id': '100000001'}]
+                return []
+
+            order_api = mock_order_api()
+            order_api.return_value.list.side_effect = list_orders
+
+            with nested(
+                patch('magento.Order', order_api, create=True),
+                patch('magento.Product', mock_product_api(), create=True),
+                patch('magento.Customer', mock_customer_api(), create=True),
+            ):
+                sales = store_view_obj.import_orders_from_store_view(
+                    txn.cursor, txn.user, store_view, context
+                )
+
+            self.assertEqual(len(sales), 1)
+            self.assertEqual(len(windows), 3)
+            self.assertEqual(
+                windows[0]['from'], store_view.last_order_import_time
+            )
+            for window, next_window in zip(windows, windows[1:]):
+                self.assertEqual(window['to'], next_window['from'])
+
+            store_view = store_view_obj.browse(
+                txn.cursor, txn.user, self.store_view_id, context
+            )
+            self.assertEqual(
+                store_view.last_order_import_time, windows[-1]['to']
+            )
+
+    @unittest.skipIf(not settings.MOCK, "requries mock settings")
+    def test_0110_import_orders_resumes_from_checkpoint(self):
+        """
+        Tests that the order import records the update time of the last
+        order imported and that the next import starts from it
+        """
+        store_view_obj = POOL.get('magento.store.store_view')
+        checkpoint_obj = POOL.get('magento.store_view.order_checkpoint')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults(txn)
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_instance': self.instance_id1,
+                'magento_store_view': self.store_view_id,
+                'magento_website': self.website_id1,
+            })
+            self.setup_order_import(txn, context)
+
+            filters_used = []
+
+            def list_orders(filters):
+                filters_used.append(filters)
+                return [
+                    {'increment_id': '100000001'},
+                    {'increment_id': '100000005'},
+                ]
+
+            order_api = mock_order_api()
+            order_api.return_value.list.side_effect = list_orders
+
+            with nested(
+                patch('magento.Order', order_api, create=True),
+                patch('magento.Product', mock_product_api(), create=True),
+                patch('magento.Customer', mock_customer_api(), create=True),
+            ):
+                store_view = store_view_obj.browse(
+                    txn.cursor, txn.user, self.store_view_id, context
+                )
+                store_view_obj.import_orders_from_store_view(
+                    txn.cursor, txn.user, store_view, context
+                )
+
+                # Highest update time among the orders imported
+                self.assertEqual(
+                    checkpoint_obj.get_last_updated_at(
+                        txn.cursor, txn.user, self.store_view_id, context
+                    ),
+                    load_json('orders', '100000005')['updated_at']
+                )
+
+                store_view = store_view_obj.browse(
+                    txn.cursor, txn.user, self.store_view_id, context
+                )
+                store_view_obj.import_orders_from_store_view(
+                    txn.cursor, txn.user, store_view, context
+                )
+
+            self.assertFalse('updated_at' in filters_used[0])
+            self.assertEqual(
+                filters_used[1]['updated_at'],
+                {'gteq': load_json('orders', '100000005')['updated_at']}
+            )
+
+    @unittest.skipIf(not settings.MOCK, "requries mock settings")
+    def test_0120_failed_order_import_is_queued_and_retried(self):
+        """
+        Tests that an order which fails to import does not stop the import
+        of other orders, is queued as a failure and is imported on retry
+        """
+        store_view_obj = POOL.get('magento.store.store_view')
+        failure_obj = POOL.get('magento.import.failure')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults(txn)
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_instance': self.instance_id1,
+                'magento_store_view': self.store_view_id,
+                'magento_website': self.website_id1,
+            })
+            self.setup_order_import(txn, context)
+
+            order_api = mock_order_api()
+            order_api.return_value.list.side_effect = lambda filters: [
+                {'increment_id': '100000001'},
+                {'increment_id': '100000005'},
+            ]
+
+            def product_info(product_id):
+                if str(product_id) == '200':
+                    raise xmlrpclib.Fault(101, 'Product not exists.')
+                return load_json('products', str(product_id))
+
+            product_api = mock_product_api()
+            product_api.return_value.info.side_effect = product_info
+
+            with nested(
+                patch('magento.Order', order_api, create=True),
+                patch('magento.Product', product_api, create=True),
+                patch('magento.Customer', mock_customer_api(), create=True),
+            ):
+                store_view = store_view_obj.browse(
+                    txn.cursor, txn.user, self.store_view_id, context
+                )
+                sales = store_view_obj.import_orders_from_store_view(
+                    txn.cursor, txn.user, store_view, context
+                )
+
+            self.assertEqual(len(sales), 1)
+            failure, = failure_obj.browse(
+                txn.cursor, txn.user, failure_obj.search(
+                    txn.cursor, txn.user, [], context=context
+                ), context=context
+            )
+            self.assertEqual(failure.increment_id, '100000005')
+            self.assertEqual(failure.attempts, 1)
+            self.assertEqual(failure.state, 'pending')
+
+            with nested(
+                patch('magento.Product', mock_product_api(), create=True),
+                patch('magento.Customer', mock_customer_api(), create=True),
+            ):
+                sales = failure_obj.retry(
+                    txn.cursor, txn.user, [failure.id], context
+                )
+
+            self.assertEqual(len(sales), 1)
+            failure = failure_obj.browse(
+                txn.cursor, txn.user, failure.id, context=context
+            )
+            self.assertEqual(failure.state, 'done')
+
+    def test_0130_lookups_are_cached_for_the_run(self):
+        """
+        Tests that the lookups made while building sale lines are cached
+        for the run and dropped when the looked up model is written
+        """
+        sale_obj = POOL.get('sale.order')
+        tax_obj = POOL.get('account.tax')
+        website_obj = POOL.get('magento.instance.website')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults(txn)
+            context = deepcopy(CONTEXT)
+            tax_id = tax_obj.create(txn.cursor, txn.user, {
+                'name': 'VAT',
+                'amount': float('0.20'),
+                'used_on_magento': True
+            })
+            context.update({
+                'magento_instance': self.instance_id1,
+                'magento_store_view': self.store_view_id,
+                'magento_website': self.website_id1,
+                'magento_cache': RunCache(),
+            })
+            cache = context['magento_cache']
+
+            for index in range(3):
+                self.assertEqual(
+                    sale_obj.get_magento_taxes(
+                        txn.cursor, txn.user, {'tax_percent': '20'}, context
+                    ), [tax_id]
+                )
+                website_obj.get_default_uom(txn.cursor, txn.user, context)
+            self.assertEqual(cache.misses, 2)
+            self.assertEqual(cache.hits, 4)
+
+            # A deepcopy of the context still shares the cache
+            self.assertTrue(deepcopy(context)['magento_cache'] is cache)
+
+            tax_obj.write(txn.cursor, txn.user, [tax_id], {
+                'amount': float('0.10'),
+            }, context=context)
+            self.assertEqual(
+                sale_obj.get_magento_taxes(
+                    txn.cursor, txn.user, {'tax_percent': '20'}, context
+                ), []
+            )
+            self.assertEqual(cache.misses, 3)
+
+            # The partners found stay cached when other partners are created
+            partner_id = POOL.get('res.partner').create(
+                txn.cursor, txn.user, {'name': 'Customer'}, context=context
+            )
+            cache.update(
+                'magento.website.partner',
+                {(self.website_id1, 1): partner_id}
+            )
+            POOL.get('magento.website.partner').create(
+                txn.cursor, txn.user, {
+                    'magento_id': 2,
+                    'website': self.website_id1,
+                    'partner': partner_id,
+                }, context=context
+            )
+            self.assertEqual(
+                cache.get_many(
+                    'magento.website.partner', [(self.website_id1, 1)]
+                ), {(self.website_id1, 1): partner_id}
+            )
+
+    @unittest.skipIf(not settings.MOCK, "requries mock settings")
+    def test_0140_imported_orders_are_not_fetched_again(self):
+        """
+        Tests that the details of listed orders which are already imported
+        are not fetched again
+        """
+        store_view_obj = POOL.get('magento.store.store_view')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults(txn)
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_instance': self.instance_id1,
+                'magento_store_view': self.store_view_id,
+                'magento_website': self.website_id1,
+            })
+            self.setup_order_import(txn, context)
+
+            listed = [{
+                'order_id': order_data['order_id'],
+                'increment_id': order_data['increment_id'],
+                'updated_at': order_data['updated_at'],
+            } for order_data in [
+                load_json('orders', '100000001'),
+                load_json('orders', '100000005'),
+            ]]
+
+            for orders, fetched in [(listed[:1], 1), (listed, 1)]:
+                order_api = mock_order_api()
+                order_api.return_value.list.side_effect = \
+                    lambda filters: orders
+
+                with nested(
+                    patch('magento.Order', order_api, create=True),
+                    patch('magento.Product', mock_product_api(), create=True),
+                    patch(
+                        'magento.Customer', mock_customer_api(), create=True
+                    ),
+                ):
+                    store_view = store_view_obj.browse(
+                        txn.cursor, txn.user, self.store_view_id, context
+                    )
+                    sales = store_view_obj.import_orders_from_store_view(
+                        txn.cursor, txn.user, store_view, context
+                    )
+
+                self.assertEqual(len(sales), 1)
+                self.assertEqual(
+                    order_api.return_value.info.call_count, fetched
+                )
+            self.assertEqual(
+                order_api.return_value.info.call_args[0][0], '100000005'
+            )
+
+    @unittest.skipIf(not settings.MOCK, "requries mock settings")
+    def test_0150_products_of_orders_are_resolved_at_once(self):
+        """
+        Tests that the unknown products of the orders listed are fetched in
+        one multiCall request and that the sales need no further product
+        lookups on magento
+        """
+        store_view_obj = POOL.get('magento.store.store_view')
+        product_obj = POOL.get('product.product')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults(txn)
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_instance': self.instance_id1,
+                'magento_store_view': self.store_view_id,
+                'magento_website': self.website_id1,
+            })
+            self.setup_order_import(txn, context)
+
+            # One of the products is already known
+            with patch('magento.Product', mock_product_api(), create=True):
+                known_product = product_obj.find_or_create_using_magento_id(
+                    txn.cursor, txn.user, 27, context
+                )
+
+            order_api = mock_order_api()
+            order_api.return_value.list.side_effect = lambda filters: [
+                {'increment_id': '100000001'},
+                {'increment_id': '100000004'},
+            ]
+            product_api = mock_product_api()
+
+            with nested(
+                patch('magento.Order', order_api, create=True),
+                patch('magento.Product', product_api, create=True),
+                patch('magento.Customer', mock_customer_api(), create=True),
+            ):
+                store_view = store_view_obj.browse(
+                    txn.cursor, txn.user, self.store_view_id, context
+                )
+                sales = store_view_obj.import_orders_from_store_view(
+                    txn.cursor, txn.user, store_view, context
+                )
+
+            self.assertEqual(len(sales), 2)
+            self.assertEqual(product_api.return_value.info.call_count, 4)
+            self.assertEqual(
+                product_api.return_value.multiCall.call_count, 1
+            )
+            calls, = product_api.return_value.multiCall.call_args[0]
+            self.assertEqual(
+                sorted(arguments[0] for path, arguments in calls),
+                [144, 158, 162, 166]
+            )
+            self.assertTrue(
+                known_product.id in [
+                    line.product_id.id for line in sales[1].order_line
+                ]
+            )
+
+    @unittest.skipIf(not settings.MOCK, "requries mock settings")
+    def test_0155_failed_product_prefetch_clears_run_cache(self):
+        """
+        Tests that the run cache is cleared when the prefetch of products
+        rolls back, as it may hold records created in the savepoint
+        """
+        store_view_obj = POOL.get('magento.store.store_view')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults(txn)
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_instance': self.instance_id1,
+                'magento_store_view': self.store_view_id,
+                'magento_website': self.website_id1,
+                'magento_cache': RunCache(),
+            })
+            context['magento_cache'].update(
+                'magento.category_tree', {self.website_id1: True}
+            )
+
+            product_api = mock_product_api()
+            product_api.return_value.multiCall.side_effect = \
+                xmlrpclib.Fault(1, 'Failed')
+            with patch('magento.Product', product_api, create=True):
+                store_view_obj.prefetch_products(
+                    txn.cursor, txn.user,
+                    [load_json('orders', '100000001')], context
+                )
+
+            self.assertTrue(product_api.return_value.multiCall.called)
+            self.assertEqual(context['magento_cache'].values, {})
+
+    @unittest.skipIf(not settings.MOCK, "requries mock settings")
+    def test_0160_export_only_orders_with_changed_state(self):
+        """
+        Tests that the order status export visits only the orders whose
+        state changed since they were imported or last exported
+        """
+        store_view_obj = POOL.get('magento.store.store_view')
+        sale_obj = POOL.get('sale.order')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults(txn)
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_instance': self.instance_id1,
+                'magento_store_view': self.store_view_id,
+                'magento_website': self.website_id1,
+            })
+            self.setup_order_import(txn, context)
+
+            order_api = mock_order_api()
+            order_api.return_value.list.side_effect = lambda filters: [
+                {'increment_id': '100000001'},
+                {'increment_id': '100000005'},
+            ]
+            with nested(
+                patch('magento.Order', order_api, create=True),
+                patch('magento.Product', mock_product_api(), create=True),
+                patch('magento.Customer', mock_customer_api(), create=True),
+            ):
+                store_view = store_view_obj.browse(
+                    txn.cursor, txn.user, self.store_view_id, context
+                )
+                sales = store_view_obj.import_orders_from_store_view(
+                    txn.cursor, txn.user, store_view, context
+                )
+
+            # Nothing to export right after the import
+            self.assertFalse(
+                store_view_obj.export_orders_to_magento(
+                    txn.cursor, txn.user, store_view, context
+                )
+            )
+
+            sale_obj.action_cancel(txn.cursor, txn.user, [sales[0].id])
+
+            with patch('magento.Order', order_api, create=True):
+                exported = store_view_obj.export_orders_to_magento(
+                    txn.cursor, txn.user, store_view, context
+                )
+            self.assertEqual([sale.id for sale in exported], [sales[0].id])
+            order_api.return_value.cancel.assert_called_once_with(
+                '100000001'
+            )
+
+            # Exported orders are not exported again
+            self.assertFalse(
+                store_view_obj.export_orders_to_magento(
+                    txn.cursor, txn.user, store_view, context
+                )
+            )
+
+    @unittest.skipIf(not settings.MOCK, "requries mock settings")
+    def test_0170_customers_of_orders_are_resolved_at_once(self):
+        """
+        Tests that the unknown customers of the orders listed are fetched in
+        one list call and that repeat customers are looked up only once
+        """
+        store_view_obj = POOL.get('magento.store.store_view')
+        partner_obj = POOL.get('res.partner')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as txn:
+            self.setup_defaults(txn)
+            context = deepcopy(CONTEXT)
+            context.update({
+                'magento_instance': self.instance_id1,
+                'magento_store_view': self.store_view_id,
+                'magento_website': self.website_id1,
+            })
+            self.setup_order_import(txn, context)
+
+            # One of the customers is already known
+            with patch('magento.Customer', mock_customer_api(), create=True):
+                known_partner = partner_obj.find_or_create_using_magento_id(
+                    txn.cursor, txn.user, 1, context
+                )
+
+            order_api = mock_order_api()
+            order_api.return_value.list.side_effect = lambda filters: [
+                {'increment_id': '100000001'},
+                {'increment_id': '100000004'},
+                {'increment_id': '100000005'},
+            ]
+            customer_api = mock_customer_api()
+
+            with nested(
+                patch('magento.Order', order_api, create=True),
+                patch('magento.Product', mock_product_api(), create=True),
+                patch('magento.Customer', customer_api, create=True),
+            ):
+                store_view = store_view_obj.browse(
+                    txn.cursor, txn.user, self.store_view_id, context
+                )
+                sales = store_view_obj.import_orders_from_store_view(
+                    txn.cursor, txn.user, store_view, context
+                )
+
+            self.assertEqual(len(sales), 3)
+            self.assertFalse(customer_api.return_value.info.called)
+            customer_api.return_value.list.assert_called_once_with({
+                'customer_id': {'in': [2]},
+            })
+            self.assertEqual(sales[0].partner_id, sales[1].partner_id)
+            self.assertEqual(sales[2].partner_id.id, known_partner.id)
+
 
 def suite():
     _suite = unittest.TestSuite()
@@ -7,7 +7,7 @@
     :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) Limited
     :license: AGPLv3, see LICENSE for more details.
 """
-from openerp.osv import osv
+from openerp.osv import osv, fields
 from openerp.tools.translate import _
 
 
@@ -15,6 +15,14 @@ class ExportInventory(osv.TransientModel):
     "Export Inventory"
     _name = 'magento.instance.website.export_inventory'
 
+    _columns = dict(
+        force_full=fields.boolean(
+            'Export All Products',
+            help="Export the stock of all products of this website, even "
+            "the ones whose stock did not change since the last export"
+        ),
+    )
+
     def export_inventory(self, cursor, user, ids, context):
         """
         Export product stock information to magento for the current website
@@ -30,6 +38,11 @@ class ExportInventory(osv.TransientModel):
         website = website_obj.browse(
             cursor, user, context.get('active_id'), context
         )
+        record = self.browse(cursor, user, ids[0], context=context)
+
+        context.update({
+            'force_full_inventory_export': record.force_full,
+        })
 
         products = website_obj.export_inventory_to_magento(
             cursor, user, website, context
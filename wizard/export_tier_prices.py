@@ -7,7 +7,7 @@
     :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) Limited
     :license: AGPLv3, see LICENSE for more details.
 """
-from openerp.osv import osv
+from openerp.osv import osv, fields
 from openerp.tools.translate import _
 
 
@@ -15,6 +15,14 @@ class ExportTierPrices(osv.TransientModel):
     "Export Tier Prices"
     _name = 'magento.store.export_tier_prices'
 
+    _columns = dict(
+        force_full=fields.boolean(
+            'Export All Products',
+            help="Export the tier prices of all products of this store, even "
+            "the ones whose tier prices did not change since the last export"
+        ),
+    )
+
     def export_tier_prices(self, cursor, user, ids, context):
         """
         Export product tier prices to magento for the current store
@@ -30,9 +38,11 @@ class ExportTierPrices(osv.TransientModel):
         store = store_obj.browse(
             cursor, user, context['active_id'], context
         )
+        record = self.browse(cursor, user, ids[0], context=context)
 
         context.update({
             'magento_store': context['active_id'],
+            'force_full_tier_price_export': record.force_full,
         })
 
         products = store_obj.export_tier_prices_to_magento(
@@ -7,10 +7,16 @@
     :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) Limited
     :license: AGPLv3, see LICENSE for more details.
 """
-from magento.catalog import Category, Product
+import magento
 from openerp.osv import osv
 from openerp.tools.translate import _
 
+from ..cache import RunCache
+from ..session import job_session
+
+#: Number of listed products resolved together
+IMPORT_BATCH_SIZE = 500
+
 
 class ImportCatalog(osv.TransientModel):
     "Import catalog"
@@ -55,7 +61,7 @@ class ImportCatalog(osv.TransientModel):
             'magento_instance': instance.id
         })
 
-        with Category(
+        with magento.Category(
             instance.url, instance.api_user, instance.api_key
         ) as category_api:
             category_tree = category_api.tree(website.magento_root_category_id)
@@ -68,6 +74,11 @@ class ImportCatalog(osv.TransientModel):
         """
         Imports products for current instance
 
+        The products listed are resolved in batches. The products already
+        imported are found with one query for each batch and only the
+        details of new products are fetched from magento, in multiCall
+        requests.
+
         :param cursor: Database cursor
         :param user: ID of current user
         :param website: Browse record of website
@@ -77,32 +88,37 @@ class ImportCatalog(osv.TransientModel):
         product_obj = self.pool.get('product.product')
 
         instance = website.instance
+        context.update({
+            'magento_website': website.id
+        })
+        if not context.get('magento_cache'):
+            context['magento_cache'] = RunCache()
 
-        with Product(
-            instance.url, instance.api_user, instance.api_key
-        ) as product_api:
-            mag_products = []
-            products = []
-
+        with job_session(instance, context) as session:
             # Products are linked to websites. But the magento api filters
             # the products based on store views. The products available on
             # website are always available on all of its store views.
             # So we get one store view for each website in current instance.
-            mag_products.extend(
-                product_api.list(
-                    store_view=website.stores[0].store_views[0].magento_id
-                )
+            mag_products = session.get(magento.Product).list(
+                store_view=website.stores[0].store_views[0].magento_id
             )
-            context.update({
-                'magento_website': website.id
-            })
-
-            for mag_product in mag_products:
-                products.append(
-                    product_obj.find_or_create_using_magento_id(
-                        cursor, user, mag_product['product_id'], context,
-                    )
+
+            products = []
+            for start in xrange(0, len(mag_products), IMPORT_BATCH_SIZE):
+                magento_ids = [
+                    int(mag_product['product_id']) for mag_product in
+                    mag_products[start:start + IMPORT_BATCH_SIZE]
+                ]
+                found = product_obj.find_or_create_all_using_magento_ids(
+                    cursor, user, magento_ids, context
                 )
+                for magento_id in magento_ids:
+                    products.append(
+                        found.get(magento_id) or
+                        product_obj.find_or_create_using_magento_id(
+                            cursor, user, magento_id, context
+                        )
+                    )
         return map(int, products)
 
     def open_products(self, cursor, user, ids, product_ids, context):
@@ -7,7 +7,7 @@
     :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) Limited
     :license: AGPLv3, see LICENSE for more details.
 """
-from openerp.osv import osv
+from openerp.osv import osv, fields
 from openerp.tools.translate import _
 
 
@@ -15,6 +15,14 @@ class UpdateCatalog(osv.TransientModel):
     "Update catalog"
     _name = 'magento.instance.update_catalog'
 
+    _columns = dict(
+        force_full=fields.boolean(
+            'Update All Products',
+            help="Update all the products of this website, even the ones "
+            "which did not change on magento since the last update"
+        ),
+    )
+
     def update_catalog(self, cursor, user, ids, context):
         """
         Update the already imported products
@@ -30,6 +38,11 @@ class UpdateCatalog(osv.TransientModel):
         website = website_obj.browse(
             cursor, user, context['active_id'], context
         )
+        record = self.browse(cursor, user, ids[0], context=context)
+
+        context.update({
+            'force_full_catalog_update': record.force_full,
+        })
 
         product_ids = self.update_products(cursor, user, website, context)
 
@@ -47,19 +60,11 @@ class UpdateCatalog(osv.TransientModel):
         :param context: Application context
         :return: List of product IDs
         """
-        product_obj = self.pool.get('product.product')
+        website_obj = self.pool.get('magento.instance.website')
 
-        context.update({
-            'magento_website': website.id
-        })
-
-        products = []
-        for mag_product in website.magento_products:
-            products.append(
-                product_obj.update_from_magento(
-                    cursor, user, mag_product.product, context=context
-                )
-            )
+        products = website_obj.update_catalog_from_magento(
+            cursor, user, website, context
+        )
 
         return map(int, products)
 